@@ -2,28 +2,32 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date, timedelta
 import time
 import logging
-from typing import Dict, Set, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set, FrozenSet, Optional, List, Tuple
 from dataclasses import dataclass, field
 
 # Import utils
 from utils.auth import AuthManager
 from utils.invoice_data import (
-    get_uninvoiced_ans, 
+    get_filters_key,
+    load_uninvoiced_ans,
     get_filter_options,
-    get_invoice_details,
+    get_preview_bundle,
     validate_invoice_selection,
     create_purchase_invoice,
-    generate_invoice_number,
+    reserve_invoice_number,
     get_payment_terms,
     calculate_days_from_term_name,
-    get_po_line_summary
+    get_po_line_summary,
+    CATEGORICAL_COLUMNS
 )
-from utils.invoice_service import InvoiceService
+from utils.invoice_service import InvoiceService, split_unit_cost
 from utils.currency_utils import (
-    get_available_currencies,
+    get_currency_lookup,
     calculate_exchange_rates,
     validate_exchange_rates,
     format_exchange_rate,
@@ -60,6 +64,9 @@ st.set_page_config(
 class InvoiceState:
     """Data class for invoice creation state"""
     selected_ans: Set[int] = field(default_factory=set)
+    selection_version: int = 0  # Bumped whenever selected_ans changes
+    selection_key: FrozenSet[int] = frozenset()  # Hashable snapshot of selected_ans
+    selection_key_version: int = 0  # selection_version the snapshot was taken at
     wizard_step: str = 'select'
     current_page: int = 1
     items_per_page: int = 50
@@ -94,24 +101,39 @@ class InvoiceState:
 class StateManager:
     """Centralized session state management"""
     
+    # Auth keys that must exist in the session; existing values are never overwritten
+    PERSISTENT_DEFAULTS = {'username': None, 'authenticated': None, 'role': None}
+    
     @staticmethod
     def initialize():
-        """Initialize session state with defaults"""
-        if 'invoice_state' not in st.session_state:
-            st.session_state.invoice_state = InvoiceState()
+        """Initialize session state with defaults (once per session)"""
+        if st.session_state.get('_invoice_state_initialized'):
+            return
+        
+        st.session_state.setdefault('invoice_state', InvoiceState())
         
         # Ensure auth state persists
-        persistent_keys = ['username', 'authenticated', 'role']
-        for key in persistent_keys:
-            if key not in st.session_state:
-                st.session_state[key] = None
+        for key, default in StateManager.PERSISTENT_DEFAULTS.items():
+            st.session_state.setdefault(key, default)
+        
+        st.session_state._invoice_state_initialized = True
     
     @staticmethod
     def get_state() -> InvoiceState:
         """Get current invoice state"""
-        if 'invoice_state' not in st.session_state:
-            StateManager.initialize()
-        return st.session_state.invoice_state
+        state = st.session_state.get('invoice_state')
+        if state is None:
+            state = st.session_state.invoice_state = InvoiceState()
+        return state
+    
+    @staticmethod
+    def get_selection_key() -> FrozenSet[int]:
+        """Get a hashable snapshot of selected_ans, rebuilt only when the selection changes"""
+        state = StateManager.get_state()
+        if state.selection_key_version != state.selection_version:
+            state.selection_key = frozenset(state.selected_ans)
+            state.selection_key_version = state.selection_version
+        return state.selection_key
     
     @staticmethod
     def reset_wizard():
@@ -119,6 +141,7 @@ class StateManager:
         state = StateManager.get_state()
         state.wizard_step = 'select'
         state.selected_ans = set()
+        state.selection_version += 1
         state.invoice_data = None
         state.details_df = None
         state.selected_df = None
@@ -141,6 +164,7 @@ class StateManager:
         state.s3_upload_success = False
         state.s3_keys = []
         state.media_ids = []
+        clear_po_summary_prefetch()
     
     @staticmethod
     def reset_filters():
@@ -149,16 +173,20 @@ class StateManager:
         state.filters = {}
         state.current_page = 1
         state.selected_ans = set()
+        state.selection_version += 1
     
     @staticmethod
-    def get_selected_dataframe(df: pd.DataFrame) -> pd.DataFrame:
-        """Get DataFrame of selected items"""
+    def get_selected_dataframe(df_by_id: pd.DataFrame) -> pd.DataFrame:
+        """Get DataFrame of selected items from ANs indexed by can_line_id"""
         state = StateManager.get_state()
         if not state.selected_ans:
             return pd.DataFrame()
         
-        selected_ids = list(state.selected_ans)
-        selected_df = df[df['can_line_id'].isin(selected_ids)].copy()
+        selection_key = StateManager.get_selection_key()
+        selected_ids = df_by_id.index.intersection(
+            pd.Index(np.fromiter(selection_key, dtype=np.int64, count=len(selection_key)))
+        )
+        selected_df = df_by_id.loc[selected_ids].reset_index(drop=True)
         
         # Ensure no duplicates
         if not selected_df['can_line_id'].is_unique:
@@ -192,8 +220,11 @@ def main():
     elif state.wizard_step == 'confirm':
         show_invoice_confirm()
 
+# Step labels for the progress indicator
+PROGRESS_STEPS = ['Select ANs', 'Review Invoice', 'Confirm & Submit']
+
 def show_progress_indicator():
-    """Show wizard progress"""
+    """Show wizard progress as theme-coloured badges"""
     state = StateManager.get_state()
     
     steps = {
@@ -204,29 +235,12 @@ def show_progress_indicator():
     
     current_step = steps.get(state.wizard_step, 1)
     
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        if current_step >= 1:
-            st.success("✅ Step 1: Select ANs")
-        else:
-            st.info("⭕ Step 1: Select ANs")
-    
-    with col2:
-        if current_step >= 2:
-            st.success("✅ Step 2: Review Invoice")
-        elif current_step == 2:
-            st.info("🔵 Step 2: Review Invoice")
-        else:
-            st.info("⭕ Step 2: Review Invoice")
-    
-    with col3:
-        if current_step >= 3:
-            st.success("✅ Step 3: Confirm & Submit")
-        elif current_step == 3:
-            st.info("🔵 Step 3: Confirm & Submit")
-        else:
-            st.info("⭕ Step 3: Confirm & Submit")
+    for col, (number, label) in zip(st.columns(len(PROGRESS_STEPS)), enumerate(PROGRESS_STEPS, start=1)):
+        with col:
+            if current_step >= number:
+                st.badge(f"Step {number}: {label}", icon="✅", color="green")
+            else:
+                st.badge(f"Step {number}: {label}", icon="⭕", color="blue")
     
     # st.markdown("---")
 
@@ -255,15 +269,19 @@ def show_an_selection():
     # Filters section
     show_filters()
     
-    # Get data with filters
-    df = get_uninvoiced_ans(state.filters)
+    # Get data with filters (completed PO lines are excluded in SQL when hidden)
+    df = load_uninvoiced_ans(get_filters_key({**state.filters, 'hide_completed_po_lines': state.hide_completed_po_lines}))
+    
+    # Start loading PO line data for the summary while the table renders
+    selected_df = StateManager.get_selected_dataframe(df)
+    prefetch_po_line_summary(selected_df)
     
     # Display results with pagination
-    display_an_results(df)
+    display_an_results(df, state.selection_version)
     
     # Summary and actions
     if state.selected_ans:
-        show_selection_summary(df, service)
+        show_selection_summary(selected_df, service)
 
 def show_filters():
     """Display filter controls"""
@@ -406,19 +424,22 @@ def show_filters():
                 StateManager.reset_filters()
                 st.rerun()
 
-def display_an_results(df: pd.DataFrame):
-    """Display AN results with pagination and filtering"""
+@st.fragment
+def display_an_results(df: pd.DataFrame, rendered_selection_version: int):
+    """
+    Display AN results with pagination and filtering
+    
+    Runs as a fragment: paging and view toggles only rerun this block.
+    A selection change escalates to a full rerun so the summary below stays in sync.
+    """
     state = StateManager.get_state()
     
-    # NEW: Filter out completed PO lines if enabled
+    if state.selection_version != rendered_selection_version:
+        st.rerun()
+    
+    # Completed PO lines are excluded in SQL, so only the fact is shown (no count)
     if state.hide_completed_po_lines:
-        # Only filter if PO analysis columns exist
-        if 'po_line_pending_invoiced_qty' in df.columns:
-            original_count = len(df)
-            df = df[df['po_line_pending_invoiced_qty'] > 0].copy()
-            filtered_count = original_count - len(df)
-            if filtered_count > 0:
-                st.info(f"ℹ️ Hiding {filtered_count} AN line(s) from completed PO lines (PO Pend = 0)")
+        st.info("ℹ️ Hiding AN lines from completed PO lines (PO Pend = 0)")
     
     total_items = len(df)
     
@@ -439,7 +460,7 @@ def display_an_results(df: pd.DataFrame):
         if items_per_page != state.items_per_page:
             state.items_per_page = items_per_page
             state.current_page = 1
-            st.rerun()
+            st.rerun(scope="fragment")
     
     with col3:
         state.show_po_analysis = st.checkbox(
@@ -450,11 +471,16 @@ def display_an_results(df: pd.DataFrame):
     
     with col4:
         # NEW: Checkbox to hide completed PO lines
-        state.hide_completed_po_lines = st.checkbox(
+        hide_completed_po_lines = st.checkbox(
             "Hide Completed POs",
             value=state.hide_completed_po_lines,
             help="Hide AN lines where PO has been fully invoiced (PO Pend = 0)"
         )
+        if hide_completed_po_lines != state.hide_completed_po_lines:
+            # The filter is applied in SQL, so the data has to be reloaded by a full rerun
+            state.hide_completed_po_lines = hide_completed_po_lines
+            state.current_page = 1
+            st.rerun()
     
     if df.empty:
         st.info("No uninvoiced ANs found with the selected filters.")
@@ -470,279 +496,230 @@ def display_an_results(df: pd.DataFrame):
     start_idx = (state.current_page - 1) * state.items_per_page
     end_idx = min(start_idx + state.items_per_page, total_items)
     page_df = df.iloc[start_idx:end_idx]
+    page_display_df = format_display_frame(df, state.show_po_analysis).iloc[start_idx:end_idx]
     
-    # Display table
-    display_an_table(page_df)
-    
-    # Pagination controls
-    display_pagination_controls(total_pages)
-
-def display_an_table(page_df: pd.DataFrame):
-    """Display the AN table with selection - FIXED for Streamlit Cloud"""
-    state = StateManager.get_state()
+    # Table and pagination share one form so row ticks are batched into a single rerun
+    display_select_all_checkbox(page_df)
     
-    with st.container():
-        # Determine columns based on view mode
-        if state.show_po_analysis:
-            # Increase AN Number column width from 1 to 1.3
-            cols = st.columns([0.5, 1.3, 1, 1.5, 1.5, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.9, 0.9])
-        else:
-            cols = st.columns([0.5, 1.2, 1.2, 2, 2, 1.2, 1, 1, 1, 1, 1.5])
-        
-        # Calculate current page selection state
-        page_ids = page_df['can_line_id'].tolist()
-        page_selected = [id for id in page_ids if id in state.selected_ans]
-        is_all_selected = len(page_selected) == len(page_ids) and len(page_ids) > 0
-        
-        # Store page_ids in session state for callback access
-        st.session_state.current_page_ids = page_ids
+    with st.form("select_form", clear_on_submit=False):
+        # Display table
+        display_an_table(page_df, page_display_df)
         
-        # Callback for select all checkbox
-        def handle_select_all_change():
-            """Callback for select all checkbox"""
-            state = StateManager.get_state()
-            page_ids = st.session_state.current_page_ids
-            
-            if st.session_state.get('select_all_checkbox'):
-                # Select all items on current page
-                state.selected_ans.update(page_ids)
-            else:
-                # Deselect all items on current page
-                state.selected_ans -= set(page_ids)
-        
-        # Select all checkbox with callback
-        cols[0].checkbox(
-            "All",
-            key="select_all_checkbox",
-            value=is_all_selected,
-            on_change=handle_select_all_change
+        st.form_submit_button(
+            "✅ Apply Selection",
+            type="primary",
+            on_click=apply_editor_selection,
+            help="Tick rows in the table, then apply them to the selection"
         )
         
-        # Column headers
-        if state.show_po_analysis:
-            display_po_analysis_headers(cols[1:])
-        else:
-            display_standard_headers(cols[1:])
-        
-        st.markdown("---")
-        
-        # Data rows
-        for idx, row in page_df.iterrows():
-            if state.show_po_analysis:
-                display_row_with_po_analysis(row)
-            else:
-                display_standard_row(row)
+        # Pagination controls
+        display_pagination_controls(total_pages)
 
-def display_standard_headers(cols):
-    """Display standard column headers"""
-    cols[0].markdown("**AN Number**")
-    cols[1].markdown("**PO Number**")
-    cols[2].markdown("**Vendor**")
-    cols[3].markdown("**Product**")
-    cols[4].markdown("**Uninv Qty**")
-    cols[5].markdown("**Unit Cost**")
-    cols[6].markdown("**VAT**")
-    cols[7].markdown("**Est. Value**")
-    cols[8].markdown("**Payment**")
-    cols[9].markdown("**PO Status**")
+@st.cache_resource
+def get_po_summary_executor() -> ThreadPoolExecutor:
+    """Shared background workers for prefetching PO line summaries while the AN table renders"""
+    return ThreadPoolExecutor(max_workers=2)
 
-def display_po_analysis_headers(cols):
-    """Display PO analysis column headers with tooltips"""
-    cols[0].markdown("**AN Number**")
-    cols[1].markdown("**PO Number**")
-    cols[2].markdown("**Vendor**")
-    cols[3].markdown("**Product**")
-    
-    # NEW: Add tooltips to quantity columns
-    cols[4].markdown(
-        "**PO Qty**",
-        help="Original PO quantity (buying UOM)\nFormula: ppo.purchase_quantity"
-    )
-    cols[5].markdown(
-        "**PO Pend**",
-        help="PO remaining to invoice (all ANs)\nFormula: PO Qty - Total Invoiced at PO level\nIncludes legacy invoices"
-    )
-    cols[6].markdown(
-        "**AN Uninv**",
-        help="AN uninvoiced quantity (this AN only)\nFormula: Arrival Qty - Invoiced from this AN"
-    )
-    cols[7].markdown(
-        "**Legacy**",
-        help="Legacy invoices (not linked to AN)\nFormula: SUM(invoiced_qty WHERE arrival_detail_id IS NULL)"
-    )
-    cols[8].markdown(
-        "**True Qty**",
-        help="Actual quantity can be invoiced\nFormula: GREATEST(0, LEAST(AN Uninv, PO Pend))\nCannot exceed PO remaining quota"
-    )
-    
-    cols[9].markdown("**Unit Cost**")
-    cols[10].markdown("**VAT**")
-    cols[11].markdown("**Est. Value**")
-    cols[12].markdown(
-        "**Status/Risk**",
-        help="⚠️LEG: Has legacy invoices\n⚠️ADJ: True Qty < AN Uninv\n⚠️EXC: PO Pend < AN Uninv\n🔴OI: Over-invoiced\n🔴OD: Over-delivered\n✅OK: Normal"
-    )
+# A prefetched summary is reused for at most this long (seconds), matching the get_po_line_summary cache
+PO_SUMMARY_PREFETCH_TTL = 60
+
+# Stable widget key for the AN data editor. Pending ticks are applied before a
+# page change (go_to_page), and the editor state resets when its rows change.
+AN_EDITOR_KEY = "an_editor"
 
-def display_standard_row(row):
-    """Display standard row with FIXED checkbox handling"""
+# Tooltips for the PO analysis columns
+PO_ANALYSIS_COLUMN_HELP = {
+    'PO Qty': "Original PO quantity (buying UOM)\nFormula: ppo.purchase_quantity",
+    'PO Pend': "PO remaining to invoice (all ANs)\nFormula: PO Qty - Total Invoiced at PO level\nIncludes legacy invoices",
+    'AN Uninv': "AN uninvoiced quantity (this AN only)\nFormula: Arrival Qty - Invoiced from this AN",
+    'Legacy': "Legacy invoices (not linked to AN)\nFormula: SUM(invoiced_qty WHERE arrival_detail_id IS NULL)",
+    'True Qty': "Actual quantity can be invoiced\nFormula: GREATEST(0, LEAST(AN Uninv, PO Pend))\nCannot exceed PO remaining quota",
+    'Status/Risk': "⚠️LEG: Has legacy invoices\n⚠️ADJ: True Qty < AN Uninv\n⚠️EXC: PO Pend < AN Uninv\n🔴OI: Over-invoiced\n🔴OD: Over-delivered\n✅OK: Normal"
+}
+
+def apply_editor_selection():
+    """Apply toggled 'Select' cells from the data editor to the selection set"""
     state = StateManager.get_state()
-    cols = st.columns([0.5, 1.2, 1.2, 2, 2, 1.2, 1, 1, 1, 1, 1.5])
-    
-    # Unique key for checkbox
-    checkbox_key = f"cb_{row['can_line_id']}"
-    
-    # Check if item is selected
-    is_selected = row['can_line_id'] in state.selected_ans
+    page_ids = st.session_state.get('current_page_ids', [])
+    editor_state = st.session_state.get(AN_EDITOR_KEY) or {}
     
-    # Store row ID in session state for callback access
-    st.session_state[f"row_id_{checkbox_key}"] = row['can_line_id']
-    
-    # Callback for individual checkbox
-    def handle_selection_change():
-        """Callback for individual checkbox"""
-        state = StateManager.get_state()
-        row_id = st.session_state[f"row_id_{checkbox_key}"]
+    for row_pos, changes in editor_state.get('edited_rows', {}).items():
+        if 'Select' not in changes:
+            continue
+        row_id = page_ids[int(row_pos)]
+        is_selected = bool(changes['Select'])
         
-        if st.session_state.get(checkbox_key):
+        # Skip rows whose tick was toggled back to the stored value
+        if is_selected == (row_id in state.selected_ans):
+            continue
+        
+        if is_selected:
             state.selected_ans.add(row_id)
         else:
             state.selected_ans.discard(row_id)
-    
-    # Checkbox with callback
-    cols[0].checkbox(
-        "Select",
-        key=checkbox_key,
-        value=is_selected,
-        on_change=handle_selection_change,
-        label_visibility="collapsed"
-    )
-    
-    # Display row data
-    cols[1].text(row['arrival_note_number'])
-    cols[2].text(row['po_number'])
-    cols[3].text(f"{row['vendor_code']} - {row['vendor'][:20]}")
-    cols[4].text(f"{row['pt_code']} - {row['product_name'][:20]}")
-    # IMPROVED: Add thousand separator for quantity
-    cols[5].text(f"{row['uninvoiced_quantity']:,.2f} {row['buying_uom']}")
-    cols[6].text(row['buying_unit_cost'])
-    
-    vat_percent = row.get('vat_percent', 0)
-    cols[7].text(f"{vat_percent:.0f}%")
-    
-    currency = row['buying_unit_cost'].split()[-1] if ' ' in str(row['buying_unit_cost']) else 'USD'
-    cols[8].text(f"{row['estimated_invoice_value']:,.2f} {currency}")
-    cols[9].text(row.get('payment_term', 'N/A'))
-    
-    po_status = row.get('po_line_status', 'UNKNOWN')
-    status_color = get_status_color(po_status)
-    
-    indicators = []
-    if row.get('po_line_is_over_delivered') == 'Y':
-        indicators.append('OD')
-    if row.get('po_line_is_over_invoiced') == 'Y':
-        indicators.append('OI')
-    if row.get('has_legacy_invoices') == 'Y':
-        indicators.append('LEG')
-    
-    status_text = f"{status_color} {po_status[:8]}"
-    if indicators:
-        status_text += f" ({','.join(indicators)})"
-    
-    cols[10].text(status_text)
+        state.selection_version += 1
 
-def display_row_with_po_analysis(row):
-    """Display row with PO analysis - FIXED checkbox handling"""
+def display_select_all_checkbox(page_df: pd.DataFrame):
+    """Select/deselect every AN on the current page"""
     state = StateManager.get_state()
-    # Increase AN Number column width from 1 to 1.3
-    cols = st.columns([0.5, 1.3, 1, 1.5, 1.5, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.9, 0.9])
     
-    # Unique key for checkbox
-    checkbox_key = f"cb_{row['can_line_id']}"
-    is_selected = row['can_line_id'] in state.selected_ans
+    # Calculate current page selection state
+    page_ids = page_df['can_line_id'].tolist()
+    is_all_selected = len(page_ids) > 0 and state.selected_ans.issuperset(page_ids)
     
-    # Store row ID for callback access
-    st.session_state[f"row_id_{checkbox_key}"] = row['can_line_id']
+    # Store page_ids in session state for callback access
+    st.session_state.current_page_ids = page_ids
     
-    # Callback for individual checkbox
-    def handle_selection_change():
-        """Callback for individual checkbox"""
+    # Callback for select all checkbox
+    def handle_select_all_change():
+        """Callback for select all checkbox"""
         state = StateManager.get_state()
-        row_id = st.session_state[f"row_id_{checkbox_key}"]
+        page_ids = set(st.session_state.current_page_ids)
+        select_all = bool(st.session_state.get('select_all_checkbox'))
         
-        if st.session_state.get(checkbox_key):
-            state.selected_ans.add(row_id)
+        # Nothing to do if the page is already in the requested state
+        if select_all and page_ids <= state.selected_ans:
+            return
+        if not select_all and page_ids.isdisjoint(state.selected_ans):
+            return
+        
+        if select_all:
+            # Select all items on current page
+            state.selected_ans |= page_ids
         else:
-            state.selected_ans.discard(row_id)
-    
-    # Checkbox with callback
-    cols[0].checkbox(
-        "Select",
-        key=checkbox_key,
-        value=is_selected,
-        on_change=handle_selection_change,
-        label_visibility="collapsed"
+            # Deselect all items on current page
+            state.selected_ans -= page_ids
+        state.selection_version += 1
+    
+    # Select all checkbox with callback
+    st.checkbox(
+        "Select all on this page",
+        key="select_all_checkbox",
+        value=is_all_selected,
+        on_change=handle_select_all_change
     )
+
+def display_an_table(page_df: pd.DataFrame, page_display_df: pd.DataFrame):
+    """Display the AN table as a single data editor with a selection column"""
+    state = StateManager.get_state()
+    page_ids = page_df['can_line_id'].tolist()
     
-    # Display row data
-    # IMPROVED: Show AN number prioritizing part after "-"
-    an_number = row['arrival_note_number']
-    if '-' in an_number:
-        # Split and show prefix + last part (numbers after last -)
-        parts = an_number.split('-')
-        if len(parts) >= 2:
-            # Show first part and last part: "AN2025117-001"
-            cols[1].text(f"{parts[0]}-{parts[-1]}")
-        else:
-            cols[1].text(an_number)
-    else:
-        cols[1].text(an_number)
-    
-    cols[2].text(row['po_number'][:10])
-    cols[3].text(f"{row['vendor_code'][:3]}-{row['vendor'][:12]}")
-    cols[4].text(f"{row['pt_code'][:8]}-{row['product_name'][:12]}")
-    
-    po_qty = row.get('po_buying_quantity', 0)
-    po_pending = row.get('po_line_pending_invoiced_qty', 0)
-    an_uninv = row['uninvoiced_quantity']
-    legacy_qty = row.get('legacy_invoice_qty', 0)
-    true_remaining = row.get('true_remaining_qty', an_uninv)
-    
-    # IMPROVED: Add thousand separator for quantities
-    cols[5].text(f"{po_qty:,.0f}")
-    cols[6].text(f"{po_pending:,.0f}")
-    cols[7].text(f"{an_uninv:,.0f}")
-    cols[8].text(f"{legacy_qty:,.0f}" if legacy_qty > 0 else "-")
-    cols[9].text(f"{true_remaining:,.0f}")
-    
-    # IMPROVED: Format unit cost with thousand separator
-    unit_cost_str = row['buying_unit_cost']
-    if ' ' in str(unit_cost_str):
-        cost_parts = unit_cost_str.split()
-        cost_value = float(cost_parts[0])
-        cols[10].text(f"{cost_value:,.0f}")
-    else:
-        cols[10].text(unit_cost_str)
+    display_df = page_display_df.reset_index(drop=True)
+    display_df.insert(0, 'Select', [row_id in state.selected_ans for row_id in page_ids])
     
-    vat_percent = row.get('vat_percent', 0)
-    cols[11].text(f"{vat_percent:.0f}%")
+    column_config = {
+        'Select': st.column_config.CheckboxColumn("Select", width="small")
+    }
+    if state.show_po_analysis:
+        for column, help_text in PO_ANALYSIS_COLUMN_HELP.items():
+            column_config[column] = st.column_config.TextColumn(column, help=help_text)
+    
+    # Single widget for the whole page; only the Select column is editable.
+    # Edits are applied by the form's submit buttons (see apply_editor_selection).
+    st.data_editor(
+        display_df,
+        column_config=column_config,
+        disabled=[col for col in display_df.columns if col != 'Select'],
+        hide_index=True,
+        use_container_width=True,
+        height=(len(display_df) + 1) * 35 + 3,
+        key=AN_EDITOR_KEY
+    )
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def format_display_frame(df: pd.DataFrame, show_po_analysis: bool) -> pd.DataFrame:
+    """
+    Format all AN rows into display strings for the AN table
     
-    # Already has thousand separator
-    cols[12].text(f"{row['estimated_invoice_value']:,.0f}")
+    Cached per data/view combination, so reruns only slice the current page.
+    """
+    if df.empty:
+        return pd.DataFrame()
+    
+    # String concatenation isn't defined for categoricals, so format from plain object columns
+    df = df.astype({col: object for col in CATEGORICAL_COLUMNS if col in df.columns})
+    
+    def column(name, default):
+        return df[name] if name in df.columns else pd.Series(default, index=df.index)
+    
+    def flag(mask, label):
+        return pd.Series(np.where(mask, label, ''), index=df.index)
+    
+    def fmt(values, spec):
+        return values.map(spec.format)
+    
+    # Split "123.45 USD" into amount and currency once for the whole column
+    unit_cost_num, unit_cost_ccy = split_unit_cost(df['buying_unit_cost'])
+    has_currency = unit_cost_ccy.notna()
+    vat = fmt(column('vat_percent', 0), '{:.0f}%')
+    over_delivered = column('po_line_is_over_delivered', None) == 'Y'
+    over_invoiced = column('po_line_is_over_invoiced', None) == 'Y'
+    
+    if not show_po_analysis:
+        currency = unit_cost_ccy.where(has_currency, 'USD')
+        po_status = column('po_line_status', 'UNKNOWN')
+        
+        indicators = (
+            flag(over_delivered, 'OD,')
+            + flag(over_invoiced, 'OI,')
+            + flag(column('has_legacy_invoices', None) == 'Y', 'LEG,')
+        ).str.rstrip(',')
+        status_text = (
+            po_status.map(get_status_color) + ' ' + po_status.str[:8]
+            + flag(indicators != '', ' (' + indicators + ')')
+        )
+        
+        return pd.DataFrame({
+            'AN Number': df['arrival_note_number'],
+            'PO Number': df['po_number'],
+            'Vendor': df['vendor_code'] + ' - ' + df['vendor'].str[:20],
+            'Product': df['pt_code'] + ' - ' + df['product_name'].str[:20],
+            'Uninv Qty': fmt(df['uninvoiced_quantity'], '{:,.2f}') + ' ' + df['buying_uom'].astype(str),
+            'Unit Cost': df['buying_unit_cost'],
+            'VAT': vat,
+            'Est. Value': fmt(df['estimated_invoice_value'], '{:,.2f}') + ' ' + currency,
+            'Payment': column('payment_term', 'N/A'),
+            'PO Status': status_text
+        }).reset_index(drop=True)
+    
+    # Show AN number prioritizing part after "-": "AN2025117-001"
+    an_number = df['arrival_note_number']
+    an_parts = an_number.str.split('-')
+    an_display = (an_parts.str[0] + '-' + an_parts.str[-1]).where(an_parts.str.len() >= 2, an_number)
+    
+    po_qty = column('po_buying_quantity', 0)
+    po_pending = column('po_line_pending_invoiced_qty', 0)
+    an_uninv = df['uninvoiced_quantity']
+    legacy_qty = column('legacy_invoice_qty', 0)
+    true_remaining = column('true_remaining_qty', an_uninv)
+    
+    # Format unit cost with thousand separator
+    unit_cost_display = fmt(unit_cost_num, '{:,.0f}').where(has_currency, df['buying_unit_cost'])
     
     # Risk indicators
-    risk_status = []
-    if row.get('po_line_is_over_delivered') == 'Y':
-        risk_status.append("🔴OD")
-    if row.get('po_line_is_over_invoiced') == 'Y':
-        risk_status.append("🔴OI")
-    if legacy_qty > 0:
-        risk_status.append("⚠️LEG")
-    if true_remaining < an_uninv:
-        risk_status.append("⚠️ADJ")
-    if po_pending < an_uninv:
-        risk_status.append("⚠️EXC")
-    
-    cols[13].text(" ".join(risk_status) if risk_status else "✅OK")
+    risk_status = (
+        flag(over_delivered, '🔴OD ')
+        + flag(over_invoiced, '🔴OI ')
+        + flag(legacy_qty > 0, '⚠️LEG ')
+        + flag(true_remaining < an_uninv, '⚠️ADJ ')
+        + flag(po_pending < an_uninv, '⚠️EXC ')
+    ).str.rstrip()
+    
+    return pd.DataFrame({
+        'AN Number': an_display,
+        'PO Number': df['po_number'].str[:10],
+        'Vendor': df['vendor_code'].str[:3] + '-' + df['vendor'].str[:12],
+        'Product': df['pt_code'].str[:8] + '-' + df['product_name'].str[:12],
+        'PO Qty': fmt(po_qty, '{:,.0f}'),
+        'PO Pend': fmt(po_pending, '{:,.0f}'),
+        'AN Uninv': fmt(an_uninv, '{:,.0f}'),
+        'Legacy': fmt(legacy_qty, '{:,.0f}').where(legacy_qty > 0, '-'),
+        'True Qty': fmt(true_remaining, '{:,.0f}'),
+        'Unit Cost': unit_cost_display,
+        'VAT': vat,
+        'Est. Value': fmt(df['estimated_invoice_value'], '{:,.0f}'),
+        'Status/Risk': risk_status.where(risk_status != '', '✅OK')
+    }).reset_index(drop=True)
 
 def get_status_color(status: str) -> str:
     """Get status color emoji"""
@@ -756,22 +733,29 @@ def get_status_color(status: str) -> str:
         'UNKNOWN_STATUS': '⚫'
     }.get(status, '⚫')
 
+def go_to_page(page: int):
+    """Apply pending row ticks, then switch page"""
+    apply_editor_selection()
+    StateManager.get_state().current_page = page
+
 def display_pagination_controls(total_pages: int):
-    """Display pagination controls"""
+    """Display pagination controls (submit buttons of the selection form)"""
     state = StateManager.get_state()
     
     st.markdown("---")
     col1, col2, col3, col4, col5 = st.columns([1, 1, 2, 1, 1])
     
     with col1:
-        if st.button("⮜ First", disabled=state.current_page == 1, use_container_width=True):
-            state.current_page = 1
-            st.rerun()
+        st.form_submit_button(
+            "⮜ First", disabled=state.current_page == 1, use_container_width=True,
+            on_click=go_to_page, args=(1,)
+        )
     
     with col2:
-        if st.button("◀️ Previous", disabled=state.current_page == 1, use_container_width=True):
-            state.current_page -= 1
-            st.rerun()
+        st.form_submit_button(
+            "◀️ Previous", disabled=state.current_page == 1, use_container_width=True,
+            on_click=go_to_page, args=(state.current_page - 1,)
+        )
     
     with col3:
         st.markdown(
@@ -780,31 +764,96 @@ def display_pagination_controls(total_pages: int):
         )
     
     with col4:
-        if st.button("Next ▶️", disabled=state.current_page == total_pages, use_container_width=True):
-            state.current_page += 1
-            st.rerun()
+        st.form_submit_button(
+            "Next ▶️", disabled=state.current_page == total_pages, use_container_width=True,
+            on_click=go_to_page, args=(state.current_page + 1,)
+        )
     
     with col5:
-        if st.button("Last ⮞", disabled=state.current_page == total_pages, use_container_width=True):
-            state.current_page = total_pages
-            st.rerun()
+        st.form_submit_button(
+            "Last ⮞", disabled=state.current_page == total_pages, use_container_width=True,
+            on_click=go_to_page, args=(total_pages,)
+        )
+
+@st.cache_data(ttl=300, show_spinner=False, max_entries=32)
+def summarize_selection(fingerprint: int, _selected_df: pd.DataFrame) -> Dict:
+    """
+    Payment term and VAT aggregates for a selection
+    
+    Keyed by the fingerprint of the rows passed in (get_frame_fingerprint), so reruns
+    over the same rows reuse it and filtered-out rows never share an entry.
+    """
+    aggregations = {'payment_term': 'unique', 'vat_percent': 'unique'}
+    if 'vat_amount' in _selected_df.columns:
+        aggregations['vat_amount'] = 'sum'
+    summary = _selected_df.agg(aggregations)
+    
+    payment_terms = [term for term in summary['payment_term'] if pd.notna(term)]
+    most_common = _selected_df['payment_term'].mode()
+    
+    return {
+        'payment_terms': payment_terms,
+        'most_common_term': most_common.iloc[0] if not most_common.empty else (payment_terms[0] if payment_terms else None),
+        'vat_rates': summary['vat_percent'].tolist(),
+        'total_vat': float(summary['vat_amount']) if 'vat_amount' in summary else None
+    }
 
-def show_selection_summary(df: pd.DataFrame, service: InvoiceService):
+def get_po_line_ids(selected_df: pd.DataFrame) -> tuple:
+    """Sorted PO line ids of the selected rows (cache/prefetch key)"""
+    if selected_df.empty or 'product_purchase_order_id' not in selected_df.columns:
+        return ()
+    return tuple(sorted(selected_df['product_purchase_order_id'].unique().tolist()))
+
+def get_pending_po_summary(po_line_ids: tuple):
+    """Prefetched PO line summary future for these PO lines, if it hasn't expired"""
+    pending = st.session_state.get('_po_summary_future')
+    if pending is None:
+        return None
+    pending_ids, submitted_at, future = pending
+    if pending_ids != po_line_ids or time.monotonic() - submitted_at > PO_SUMMARY_PREFETCH_TTL:
+        return None
+    return future
+
+def clear_po_summary_prefetch():
+    """Forget the prefetched PO line summary (selection reset or quantities changed)"""
+    st.session_state.pop('_po_summary_future', None)
+
+def prefetch_po_line_summary(selected_df: pd.DataFrame):
+    """Load the PO line summary for the selection in a background thread"""
+    po_line_ids = get_po_line_ids(selected_df)
+    if not po_line_ids:
+        return
+    
+    # Don't resubmit while the same PO lines are already loading/loaded
+    if get_pending_po_summary(po_line_ids) is not None:
+        return
+    
+    st.session_state._po_summary_future = (
+        po_line_ids, time.monotonic(), get_po_summary_executor().submit(get_po_line_summary, po_line_ids)
+    )
+
+def get_prefetched_po_line_summary(po_line_ids: tuple) -> pd.DataFrame:
+    """Get the prefetched PO line summary, loading it directly if no prefetch matches"""
+    future = get_pending_po_summary(po_line_ids)
+    if future is not None:
+        try:
+            return future.result(timeout=30)
+        except Exception as e:
+            logger.warning(f"PO line summary prefetch failed: {e}")
+    return get_po_line_summary(po_line_ids)
+
+def show_selection_summary(selected_df: pd.DataFrame, service: InvoiceService):
     """Show summary of selected items"""
     state = StateManager.get_state()
     
-    selected_df = StateManager.get_selected_dataframe(df)
-    
     if selected_df.empty:
         return
     
-    # Calculate totals
-    if 'product_purchase_order_id' in selected_df.columns:
-        po_line_ids = selected_df['product_purchase_order_id'].unique().tolist()
-        po_summary_df = get_po_line_summary(po_line_ids)
-    else:
-        po_summary_df = pd.DataFrame()
+    # PO line data was prefetched in show_an_selection
+    po_line_ids = get_po_line_ids(selected_df)
+    po_summary_df = get_prefetched_po_line_summary(po_line_ids) if po_line_ids else None
     
+    # Calculate totals
     totals = service.calculate_invoice_totals(selected_df)
     
     # Display metrics
@@ -815,16 +864,17 @@ def show_selection_summary(df: pd.DataFrame, service: InvoiceService):
     col3.metric("Total Lines", totals['total_lines'])
     col4.metric("Est. Total Value", f"{totals['total_value']:,.2f} {totals['currency']}")
     
-    if 'vat_amount' in selected_df.columns:
-        total_vat = selected_df['vat_amount'].sum()
-        col5.metric("Total VAT", f"{total_vat:,.2f} {totals['currency']}")
+    summary = summarize_selection(get_frame_fingerprint(selected_df), selected_df)
+    
+    if summary['total_vat'] is not None:
+        col5.metric("Total VAT", f"{summary['total_vat']:,.2f} {totals['currency']}")
     
     # Show warnings
-    payment_terms = selected_df['payment_term'].dropna().unique()
+    payment_terms = summary['payment_terms']
     if len(payment_terms) > 1:
         st.warning(f"⚠️ Multiple payment terms found: {', '.join(payment_terms)}. The most common term will be used.")
     
-    vat_rates = selected_df['vat_percent'].unique()
+    vat_rates = summary['vat_rates']
     if len(vat_rates) > 1:
         st.info(f"ℹ️ Multiple VAT rates found: {', '.join([f'{v:.0f}%' for v in vat_rates])}. Each line will retain its respective VAT rate.")
     
@@ -835,7 +885,7 @@ def show_selection_summary(df: pd.DataFrame, service: InvoiceService):
     if not is_valid:
         st.error(f"❌ {error_msg}")
     else:
-        validation_result, validation_msgs = service.validate_invoice_with_po_level(selected_df)
+        validation_result, validation_msgs = service.validate_invoice_with_po_level(selected_df, po_summary_df)
         
         if not validation_result['can_invoice']:
             st.error(f"❌ {validation_msgs['error']}")
@@ -847,8 +897,8 @@ def show_selection_summary(df: pd.DataFrame, service: InvoiceService):
             st.success("✅ Selected items can be invoiced together")
             
             if st.button("➡️ Proceed to Preview", type="primary", use_container_width=True):
-                # Store selected dataframe
-                state.selected_df = selected_df
+                # Store selected dataframe (already de-duplicated by get_selected_dataframe)
+                state.selected_df = selected_df.reset_index(drop=True)
                 state.wizard_step = 'preview'
                 st.rerun()
 
@@ -856,6 +906,30 @@ def show_selection_summary(df: pd.DataFrame, service: InvoiceService):
 # STEP 2: INVOICE PREVIEW
 # ============================================================================
 
+# Columns the cached selection/preview summaries are computed from; a change in any of
+# them (e.g. quantities or costs refreshed from the DB) must produce a new fingerprint
+FINGERPRINT_COLUMNS = [
+    'can_line_id', 'uninvoiced_quantity', 'true_remaining_qty', 'buying_unit_cost',
+    'vat_percent', 'vat_amount', 'payment_term'
+]
+
+def get_frame_fingerprint(df: pd.DataFrame) -> int:
+    """Cheap content key for a selection frame (hash of its lines and the values summarized from them)"""
+    columns = [col for col in FINGERPRINT_COLUMNS if col in df.columns]
+    return int(pd.util.hash_pandas_object(df[columns], index=False).sum())
+
+@st.cache_data(ttl=300, max_entries=32)
+def build_preview_summary(fingerprint: int, _selected_df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Summary table and base-currency totals for the preview step
+    
+    Keyed by the selection fingerprint, so editing other preview fields doesn't rebuild them.
+    """
+    return (
+        InvoiceService.prepare_invoice_summary(_selected_df),
+        InvoiceService.calculate_invoice_totals_with_vat(_selected_df)
+    )
+
 def show_invoice_preview():
     """Step 2: Invoice Preview"""
     state = StateManager.get_state()
@@ -869,37 +943,36 @@ def show_invoice_preview():
             st.rerun()
         return
     
-    # Get invoice details
-    unique_can_ids = list(state.selected_ans)
+    # Get invoice details (sorted tuple keeps the cache key stable across reruns)
+    unique_can_ids = tuple(sorted(StateManager.get_selection_key()))
     
+    load_error = "Could not load invoice details. Please try again."
     with st.spinner("Loading invoice details..."):
-        details_df = get_invoice_details(unique_can_ids)
+        try:
+            details_df, invoice_number = get_preview_bundle(unique_can_ids, state.is_advance_payment)
+        except ValueError as e:
+            details_df, invoice_number, load_error = pd.DataFrame(), None, str(e)
     
     if details_df.empty:
-        st.error("Could not load invoice details. Please try again.")
+        st.error(load_error)
         if st.button("⬅️ Back to Selection"):
             state.wizard_step = 'select'
             st.rerun()
         return
     
-    # Ensure no duplicates
-    details_df = details_df.drop_duplicates(subset=['arrival_detail_id'])
     state.details_df = details_df
     
-    # Get currency info
-    po_currency_id = details_df['po_currency_id'].iloc[0] if not details_df.empty else 1
-    po_currency_code = details_df['po_currency_code'].iloc[0] if not details_df.empty else 'USD'
+    # Header fields shared by every line (details_df is non-empty here)
+    first_row = details_df.iloc[0]
+    po_currency_id = first_row['po_currency_id']
+    po_currency_code = first_row['po_currency_code']
     
     st.markdown("### 📄 Invoice Information")
     
     # Initialize payment term if needed
     if state.selected_payment_term is None:
-        unique_payment_terms = state.selected_df['payment_term'].dropna().unique().tolist()
-        if unique_payment_terms:
-            most_common = state.selected_df['payment_term'].mode()
-            state.selected_payment_term = most_common.iloc[0] if not most_common.empty else unique_payment_terms[0]
-        else:
-            state.selected_payment_term = 'Net 30'
+        summary = summarize_selection(get_frame_fingerprint(state.selected_df), state.selected_df)
+        state.selected_payment_term = summary['most_common_term'] or 'Net 30'
     
     # Invoice type selection
     col1, col2 = st.columns(2)
@@ -915,11 +988,6 @@ def show_invoice_preview():
             state.is_advance_payment = advance_payment
             st.rerun()
     
-    # Generate invoice number
-    vendor_id = details_df['vendor_id'].iloc[0] if not details_df.empty else None
-    buyer_id = details_df['entity_id'].iloc[0] if not details_df.empty else None
-    invoice_number = generate_invoice_number(vendor_id, buyer_id, state.is_advance_payment)
-    
     with col2:
         if state.is_advance_payment:
             st.info("🔵 **Invoice Type: Advance Payment (PI)**")
@@ -941,7 +1009,7 @@ def show_currency_selection(po_currency_code: str, po_currency_id: int):
     
     st.markdown("### 💱 Currency Selection")
     
-    currencies_df = get_available_currencies()
+    currency_options, currency_display, currency_ids = get_currency_lookup()
     
     col1, col2, col3 = st.columns(3)
     
@@ -949,9 +1017,6 @@ def show_currency_selection(po_currency_code: str, po_currency_id: int):
         st.info(f"**PO Currency:** {po_currency_code}")
     
     with col2:
-        currency_options = currencies_df['code'].tolist()
-        currency_display = [f"{row['code']} - {row['name']}" for _, row in currencies_df.iterrows()]
-        
         default_index = 0
         if po_currency_code in currency_options:
             default_index = currency_options.index(po_currency_code)
@@ -966,7 +1031,7 @@ def show_currency_selection(po_currency_code: str, po_currency_id: int):
         )
         
         invoice_currency_code = selected_currency_display.split(' - ')[0]
-        invoice_currency_id = currencies_df[currencies_df['code'] == invoice_currency_code]['id'].iloc[0]
+        invoice_currency_id = currency_ids[invoice_currency_code]
         
         state.invoice_currency_code = invoice_currency_code
         state.invoice_currency_id = invoice_currency_id
@@ -1006,18 +1071,21 @@ def show_payment_terms():
     state = StateManager.get_state()
     service = InvoiceService()
     
-    unique_payment_terms = state.selected_df['payment_term'].dropna().unique().tolist()
+    unique_payment_terms = summarize_selection(
+        get_frame_fingerprint(state.selected_df), state.selected_df
+    )['payment_terms']
     
     term_options = {}
     
     if unique_payment_terms:
         all_payment_terms_df = get_payment_terms()
+        # Name -> first matching DB row, built once instead of masking the frame per term
+        terms_by_name = all_payment_terms_df.drop_duplicates(subset=['name']).set_index('name', drop=False).to_dict('index')
         
         for term_name in unique_payment_terms:
-            db_match = all_payment_terms_df[all_payment_terms_df['name'] == term_name]
+            row = terms_by_name.get(term_name)
             
-            if not db_match.empty:
-                row = db_match.iloc[0]
+            if row is not None:
                 term_options[term_name] = {
                     'id': int(row['id']),
                     'days': int(row['days']),
@@ -1136,7 +1204,12 @@ def show_invoice_form(invoice_number: str, po_currency_code: str, service: Invoi
         col1, col2 = st.columns(2)
         
         with col1:
-            st.text_input("Invoice Number", value=invoice_number, disabled=True)
+            st.text_input(
+                "Invoice Number",
+                value=invoice_number,
+                disabled=True,
+                help="Proposed number; the final number is assigned when the invoice is created"
+            )
             st.text_input("Invoice Date", value=str(state.invoice_date), disabled=True)
             st.text_input("Payment Terms", value=state.selected_payment_term, disabled=True)
         
@@ -1170,19 +1243,20 @@ def show_invoice_form(invoice_number: str, po_currency_code: str, service: Invoi
         st.markdown("### 📊 Invoice Summary")
         
         # Calculate totals
+        summary_df, base_totals = build_preview_summary(get_frame_fingerprint(state.selected_df), state.selected_df)
         if po_currency_code != state.invoice_currency_code:
             converted_amounts = get_invoice_amounts_in_currency(
                 state.selected_df,
                 po_currency_code,
-                state.invoice_currency_code
+                state.invoice_currency_code,
+                exchange_rate=(state.exchange_rates or {}).get('po_to_invoice_rate')
             )
-            totals = converted_amounts if converted_amounts else service.calculate_invoice_totals_with_vat(state.selected_df)
+            totals = converted_amounts if converted_amounts else base_totals
         else:
-            totals = service.calculate_invoice_totals_with_vat(state.selected_df)
+            totals = base_totals
             totals['currency'] = state.invoice_currency_code
         
         # Display summary
-        summary_df = service.prepare_invoice_summary(state.selected_df)
         st.dataframe(summary_df, use_container_width=True, hide_index=True)
         
         # Show totals
@@ -1190,7 +1264,7 @@ def show_invoice_form(invoice_number: str, po_currency_code: str, service: Invoi
         with col3:
             st.markdown("**Invoice Totals**")
             st.text(f"Lines: {len(state.selected_df)}")
-            st.text(f"Quantity: {state.selected_df['uninvoiced_quantity'].sum():,.2f}")
+            st.text(f"Quantity: {base_totals['total_quantity']:,.2f}")
             st.text(f"Subtotal: {totals['subtotal']:,.2f} {totals['currency']}")
             st.text(f"VAT: {totals['total_vat']:,.2f} {totals['currency']}")
             st.text(f"Total: {totals['total_with_vat']:,.2f} {totals['currency']}")
@@ -1233,6 +1307,7 @@ def show_invoice_form(invoice_number: str, po_currency_code: str, service: Invoi
         
         # Prepare invoice data
         usd_rate = 1.0 if state.invoice_currency_code == 'USD' else state.exchange_rates.get('usd_exchange_rate', None)
+        first_row = state.details_df.iloc[0]
         
         state.invoice_data = {
             'invoice_number': invoice_number,
@@ -1242,8 +1317,8 @@ def show_invoice_form(invoice_number: str, po_currency_code: str, service: Invoi
             'total_invoiced_amount': totals['total_with_vat'],
             'currency_id': state.invoice_currency_id,
             'usd_exchange_rate': usd_rate,
-            'seller_id': state.details_df['vendor_id'].iloc[0],
-            'buyer_id': state.details_df['entity_id'].iloc[0],
+            'seller_id': first_row['vendor_id'],
+            'buyer_id': first_row['entity_id'],
             'payment_term_id': state.payment_term_id,
             'email_to_accountant': 1 if state.email_to_accountant else 0,
             'created_by': st.session_state.username,
@@ -1426,32 +1501,27 @@ def display_confirmation_line_items(details_df: pd.DataFrame, selected_df: pd.Da
     """Display line items for confirmation"""
     st.markdown("### 📋 Line Items")
     
-    # Merge dataframes
-    df_display = pd.merge(
-        details_df[['arrival_detail_id', 'arrival_note_number', 'po_number', 'product_name', 'uninvoiced_quantity', 'buying_unit_cost']],
-        selected_df[['can_line_id', 'vat_percent']],
-        left_on='arrival_detail_id',
-        right_on='can_line_id',
-        how='left'
-    )
+    # Attach VAT by can_line_id (unique after selection dedupe)
+    vat_map = dict(zip(selected_df['can_line_id'].to_numpy(), selected_df['vat_percent'].to_numpy()))
+    df_display = details_df[['arrival_note_number', 'po_number', 'product_name', 
+                             'uninvoiced_quantity', 'buying_unit_cost']].reset_index(drop=True)
+    df_display['vat_percent'] = details_df['arrival_detail_id'].map(vat_map).to_numpy()
     
     # Add ID column
     df_display.insert(0, 'id', range(1, len(df_display) + 1))
     
-    # Select columns to display
-    df_display = df_display[['id', 'arrival_note_number', 'po_number', 'product_name', 
-                            'uninvoiced_quantity', 'buying_unit_cost', 'vat_percent']].copy()
+    df_display['vat_percent'] = df_display['vat_percent'].map('{:.0f}%'.format)
     
     # Format based on currency conversion
     if invoice_data['po_currency_code'] != invoice_data['invoice_currency_code']:
-        df_display['converted_unit_cost'] = df_display['buying_unit_cost'].apply(
-            lambda x: f"{float(x.split()[0]) * invoice_data['po_to_invoice_rate']:,.2f} {invoice_data['invoice_currency_code']}"
+        unit_cost_num, _ = split_unit_cost(df_display['buying_unit_cost'])
+        df_display['converted_unit_cost'] = (
+            (unit_cost_num * invoice_data['po_to_invoice_rate']).map('{:,.2f}'.format)
+            + f" {invoice_data['invoice_currency_code']}"
         )
-        df_display['vat_percent'] = df_display['vat_percent'].apply(lambda x: f"{x:.0f}%")
         df_display.columns = ['ID', 'AN Number', 'PO Number', 'Product', 'Quantity', 'Original Cost', 'VAT', 'Invoice Cost']
         display_cols = ['ID', 'AN Number', 'PO Number', 'Product', 'Quantity', 'Original Cost', 'Invoice Cost', 'VAT']
     else:
-        df_display['vat_percent'] = df_display['vat_percent'].apply(lambda x: f"{x:.0f}%")
         df_display.columns = ['ID', 'AN Number', 'PO Number', 'Product', 'Quantity', 'Unit Cost', 'VAT']
         display_cols = ['ID', 'AN Number', 'PO Number', 'Product', 'Quantity', 'Unit Cost', 'VAT']
     
@@ -1479,7 +1549,15 @@ def create_invoice_final(invoice_data: Dict, details_df: pd.DataFrame):
             return
         
         # Step 1: Handle file uploads if any
+        invoice_number = None
         if state.uploaded_files:
+            # Reserve the final number first so the file names match the stored invoice
+            invoice_number = reserve_invoice_number(
+                invoice_data['seller_id'],
+                invoice_data['buyer_id'],
+                bool(invoice_data.get('advance_payment'))
+            )
+            
             with st.spinner(f"📤 Uploading {len(state.uploaded_files)} file(s) to S3..."):
                 try:
                     # Initialize S3 manager
@@ -1488,7 +1566,7 @@ def create_invoice_final(invoice_data: Dict, details_df: pd.DataFrame):
                     # Prepare files for upload
                     prepared_files = prepare_files_for_upload(
                         state.uploaded_files,
-                        invoice_data['invoice_number']
+                        invoice_number
                     )
                     
                     # Upload files to S3
@@ -1539,7 +1617,8 @@ def create_invoice_final(invoice_data: Dict, details_df: pd.DataFrame):
                 invoice_data,
                 details_df,
                 keycloak_id,  # Pass keycloak_id directly, not username
-                media_ids=media_ids_created if media_ids_created else None
+                media_ids=media_ids_created if media_ids_created else None,
+                invoice_number=invoice_number
             )
             
             if success:
@@ -1557,7 +1636,8 @@ def create_invoice_final(invoice_data: Dict, details_df: pd.DataFrame):
                     'attachments': len(media_ids_created)
                 }
                 
-                # Reset wizard state
+                # PO remaining quantities changed: drop cached summaries, then reset the wizard
+                get_po_line_summary.clear()
                 StateManager.reset_wizard()
                 
                 # Show redirect message
@@ -2,6 +2,7 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date, timedelta
 import io
 from typing import Optional, Dict, List
@@ -25,6 +26,34 @@ auth = AuthManager()
 auth.require_auth()
 service = InvoiceService()
 
+# Date filter windows in days, looked up instead of branching per option
+DATE_FILTER_DAYS = {
+    "Last 7 days": 7,
+    "Last 30 days": 30,
+    "Last 90 days": 90,
+}
+ANALYTICS_PERIOD_DAYS = {
+    "Last 30 days": 30,
+    "Last 90 days": 90,
+    "Last 6 months": 180,
+    "Last Year": 365,
+}
+
+# Invoice list columns (source -> header), in display order
+DISPLAY_COLUMNS = {
+    'id': 'id',
+    'invoice_number': 'Invoice #',
+    'invoice_type': 'Type',
+    'vendor': 'Vendor',
+    'commercial_invoice_no': 'Commercial #',
+    'amount_display': 'Amount',
+    'invoiced_date': 'Invoice Date',
+    'due_date': 'Due Date',
+    'payment_status': 'Payment Status',
+    'days_overdue': 'Days Overdue',
+    'created_by': 'Created By'
+}
+
 # Session state for selected invoice
 if 'selected_invoice_id' not in st.session_state:
     st.session_state.selected_invoice_id = None
@@ -145,8 +174,8 @@ def show_invoice_list():
     
     st.markdown("---")
     
-    # Create rows for each invoice
-    for idx, row in df_display.iterrows():
+    # Create rows for each invoice (plain dicts, no per-row Series)
+    for row in df_display.to_dict('records'):
         with st.container():
             cols = st.columns([0.8, 1.5, 1, 1.5, 1.5, 1.2, 1, 1, 1, 1, 1.5])
             
@@ -328,12 +357,8 @@ def show_invoice_view(invoice_data: Dict):
     
     if not line_items.empty:
         # Format line items for display
-        line_items['amount_display'] = line_items.apply(
-            lambda r: f"{r['amount']:,.2f}", axis=1
-        )
-        line_items['quantity_display'] = line_items.apply(
-            lambda r: f"{r['purchased_invoice_quantity']:,.2f}", axis=1
-        )
+        line_items['amount_display'] = line_items['amount'].map('{:,.2f}'.format)
+        line_items['quantity_display'] = line_items['purchased_invoice_quantity'].map('{:,.2f}'.format)
         
         display_cols = ['po_number', 'product_name', 'quantity_display', 
                        'amount_display', 'vat_gst', 'arrival_note_number']
@@ -498,17 +523,7 @@ def show_analytics():
         )
     
     # Filter data based on date range
-    today = pd.Timestamp.now()
-    if date_range == "Last 30 days":
-        date_threshold = today - timedelta(days=30)
-    elif date_range == "Last 90 days":
-        date_threshold = today - timedelta(days=90)
-    elif date_range == "Last 6 months":
-        date_threshold = today - timedelta(days=180)
-    else:
-        date_threshold = today - timedelta(days=365)
-    
-    df['invoiced_date'] = pd.to_datetime(df['invoiced_date'])
+    date_threshold = pd.Timestamp.now() - pd.Timedelta(days=ANALYTICS_PERIOD_DAYS.get(date_range, 365))
     df = df[df['invoiced_date'] >= date_threshold]
     
     # Summary cards
@@ -526,7 +541,7 @@ def show_analytics():
     
     with col3:
         # Calculate total by currency
-        main_currency = df.groupby('currency')['total_invoiced_amount'].sum().idxmax() if not df.empty else 'USD'
+        main_currency = df.groupby('currency', observed=True)['total_invoiced_amount'].sum().idxmax() if not df.empty else 'USD'
         total_amount = df[df['currency'] == main_currency]['total_invoiced_amount'].sum()
         st.metric(f"Total {main_currency}", f"{total_amount:,.2f}")
     
@@ -541,7 +556,7 @@ def show_analytics():
     
     with col1:
         if 'payment_status' in df.columns:
-            payment_summary = df.groupby('payment_status')['total_invoiced_amount'].agg(['sum', 'count'])
+            payment_summary = df.groupby('payment_status', observed=True)['total_invoiced_amount'].agg(['sum', 'count'])
             payment_summary.columns = ['Total Amount', 'Count']
             st.dataframe(payment_summary, use_container_width=True)
     
@@ -574,7 +589,7 @@ def show_analytics():
     with col2:
         # Top vendors
         st.markdown("#### Top 10 Vendors")
-        top_vendors = df.groupby('vendor')['total_invoiced_amount'].agg(['sum', 'count']).round(2)
+        top_vendors = df.groupby('vendor', observed=True)['total_invoiced_amount'].agg(['sum', 'count']).round(2)
         top_vendors.columns = ['Total Amount', 'Invoice Count']
         top_vendors = top_vendors.sort_values('Total Amount', ascending=False).head(10)
         st.dataframe(top_vendors, use_container_width=True)
@@ -584,21 +599,21 @@ def show_analytics():
     
     col1, col2, col3 = st.columns(3)
     
-    df['invoice_type'] = df['invoice_number'].apply(
-        lambda x: 'Advance Payment' if x.endswith('-A') else 'Commercial Invoice'
-    )
+    is_advance = df['is_advance'].to_numpy()
+    df['invoice_type'] = np.where(is_advance, 'Advance Payment', 'Commercial Invoice')
     
-    type_dist = df['invoice_type'].value_counts()
+    advance_count = int(is_advance.sum())
+    commercial_count = len(df) - advance_count
     
     with col1:
-        st.metric("Commercial Invoices", type_dist.get('Commercial Invoice', 0))
+        st.metric("Commercial Invoices", commercial_count)
     
     with col2:
-        st.metric("Advance Payments", type_dist.get('Advance Payment', 0))
+        st.metric("Advance Payments", advance_count)
     
     with col3:
-        if len(type_dist) > 0:
-            ci_percent = (type_dist.get('Commercial Invoice', 0) / len(df)) * 100
+        if len(df) > 0:
+            ci_percent = (commercial_count / len(df)) * 100
             st.metric("CI Percentage", f"{ci_percent:.1f}%")
 
 # Helper functions
@@ -624,9 +639,9 @@ def get_filtered_invoices(date_filter, invoice_search, vendor_search,
     
     # Filter by invoice type
     if invoice_type_filter == "Commercial Invoice":
-        df = df[df['invoice_number'].str.endswith('-P')]
+        df = df[~df['is_advance']]
     elif invoice_type_filter == "Advance Payment":
-        df = df[df['invoice_number'].str.endswith('-A')]
+        df = df[df['is_advance']]
     
     # Status filter - now using payment_status from view
     if status_filter != "All":
@@ -639,80 +654,52 @@ def get_filtered_invoices(date_filter, invoice_search, vendor_search,
     # Date filtering - using invoiced_date instead of created_date
     if date_filter != "All Time" and 'invoiced_date' in df.columns:
         today = pd.Timestamp.now()
-        if date_filter == "Last 7 days":
-            date_threshold = today - timedelta(days=7)
-        elif date_filter == "Last 30 days":
-            date_threshold = today - timedelta(days=30)
-        elif date_filter == "Last 90 days":
-            date_threshold = today - timedelta(days=90)
+        if date_filter in DATE_FILTER_DAYS:
+            date_threshold = today - pd.Timedelta(days=DATE_FILTER_DAYS[date_filter])
         elif date_filter == "This Month":
-            date_threshold = today.replace(day=1)
-        elif date_filter == "Custom":
-            # Handle custom date range
-            pass
+            date_threshold = today.normalize().replace(day=1)
         else:
+            # Custom range is not applied here yet
             date_threshold = None
         
-        if 'date_threshold' in locals() and date_threshold is not None:
-            df['invoiced_date'] = pd.to_datetime(df['invoiced_date'])
+        if date_threshold is not None:
             df = df[df['invoiced_date'] >= date_threshold]
     
     return df
 
 def prepare_display_dataframe(df):
     """Prepare dataframe for display"""
-    df_display = df.copy()
-    
-    # Add invoice type
-    df_display['invoice_type'] = df_display['invoice_number'].apply(
-        lambda x: 'AP' if x.endswith('-A') else 'CI'
-    )
-    
-    # Format dates
-    if 'invoiced_date' in df_display.columns:
-        df_display['invoiced_date'] = pd.to_datetime(df_display['invoiced_date']).dt.strftime('%Y-%m-%d')
-    if 'due_date' in df_display.columns:
-        df_display['due_date'] = pd.to_datetime(df_display['due_date']).dt.strftime('%Y-%m-%d')
-    
-    # Format amount
-    df_display['amount_display'] = df_display.apply(
-        lambda row: f"{row['total_invoiced_amount']:,.0f} {row.get('currency', 'USD')}", axis=1
-    )
-    
-    # Add or format payment status
-    if 'payment_status' not in df_display.columns:
-        df_display['payment_status'] = 'Unknown'
-    
-    # Add days overdue if not present
-    if 'days_overdue' not in df_display.columns:
-        df_display['days_overdue'] = 0
-    
-    # Select and rename columns
-    display_columns = {
-        'id': 'id',
-        'invoice_number': 'Invoice #',
-        'invoice_type': 'Type',
-        'vendor': 'Vendor',
-        'commercial_invoice_no': 'Commercial #',
-        'amount_display': 'Amount',
-        'invoiced_date': 'Invoice Date',
-        'due_date': 'Due Date',
-        'payment_status': 'Payment Status',
-        'days_overdue': 'Days Overdue',
-        'created_by': 'Created By'
+    # Derived columns; dates arrive already parsed from get_recent_invoices
+    currency = df['currency'].astype(str) if 'currency' in df.columns else 'USD'
+    derived = {
+        'invoice_type': pd.Series(np.where(df['is_advance'], 'AP', 'CI'), index=df.index),
+        'amount_display': df['total_invoiced_amount'].map('{:,.0f}'.format) + ' ' + currency,
+    }
+    for col in ('invoiced_date', 'due_date'):
+        if col in df.columns:
+            derived[col] = df[col].dt.strftime('%Y-%m-%d')
+    
+    # Defaults for columns the view may not provide
+    if 'payment_status' not in df.columns:
+        derived['payment_status'] = 'Unknown'
+    if 'days_overdue' not in df.columns:
+        derived['days_overdue'] = 0
+    
+    # Build only the displayed columns, in display order, instead of copying the whole frame
+    columns = {
+        col: derived[col] if col in derived else df[col]
+        for col in DISPLAY_COLUMNS
+        if col in derived or col in df.columns
     }
     
-    # Keep only existing columns
-    existing_cols = {k: v for k, v in display_columns.items() if k in df_display.columns}
-    
-    return df_display[list(existing_cols.keys())].rename(columns=existing_cols)
+    return pd.DataFrame(columns).rename(columns=DISPLAY_COLUMNS)
 
 def show_summary_metrics(df):
     """Show summary metrics for invoices"""
     st.markdown("### 📈 Summary")
     
     # Group by currency
-    currency_groups = df.groupby('currency')['total_invoiced_amount'].agg(['sum', 'count', 'mean'])
+    currency_groups = df.groupby('currency', observed=True)['total_invoiced_amount'].agg(['sum', 'count', 'mean'])
     
     cols = st.columns(min(len(currency_groups) + 1, 5))
     
@@ -720,15 +707,21 @@ def show_summary_metrics(df):
     cols[0].metric("Total Invoices", len(df))
     
     # Metrics for each currency
-    for idx, (currency, stats) in enumerate(currency_groups.iterrows()):
+    rows = currency_groups[['sum', 'count']].itertuples(name=None)
+    for idx, (currency, total, count) in enumerate(rows):
         col_idx = (idx + 1) % 5
         with cols[col_idx]:
             st.metric(
                 f"{currency}",
-                f"{stats['sum']:,.0f}",
-                f"{stats['count']} invoices"
+                f"{total:,.0f}",
+                f"{count} invoices"
             )
 
+def select_all_invoices(invoice_ids: List[int]):
+    """Tick the row checkbox of every listed invoice"""
+    for invoice_id in invoice_ids:
+        st.session_state[f"select_{invoice_id}"] = True
+
 def show_bulk_actions(df):
     """Show bulk action options"""
     col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
@@ -740,10 +733,8 @@ def show_bulk_actions(df):
         st.text(f"Selected: {selected_count} invoices")
     
     with col2:
-        if st.button("Select All"):
-            for _, row in df.iterrows():
-                st.session_state[f"select_{row['id']}"] = True
-            st.rerun()
+        # Runs as a callback, before the row checkboxes are created on the next run
+        st.button("Select All", on_click=select_all_invoices, args=(df['id'].tolist(),))
     
     with col3:
         if st.button("Clear Selection"):
@@ -757,6 +748,19 @@ def show_bulk_actions(df):
             if st.button(f"Export {selected_count} Selected"):
                 st.info("Exporting selected invoices...")
 
+@st.cache_data(ttl=300, show_spinner=False)  # Rebuild only when the exported rows change
+def build_excel_bytes(df: pd.DataFrame) -> bytes:
+    """Render the invoice list as an Excel workbook"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name='Invoices', index=False)
+    return buffer.getvalue()
+
+@st.cache_data(ttl=300, show_spinner=False)  # Rebuild only when the exported rows change
+def build_csv_bytes(df: pd.DataFrame) -> bytes:
+    """Render the invoice list as CSV"""
+    return df.to_csv(index=False).encode('utf-8')
+
 def show_export_options(df):
     """Show export options"""
     st.markdown("---")
@@ -766,13 +770,9 @@ def show_export_options(df):
     
     with col1:
         # Export to Excel
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Invoices', index=False)
-        
         st.download_button(
             label="📊 Download Excel",
-            data=buffer.getvalue(),
+            data=build_excel_bytes(df),
             file_name=f"invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True
@@ -780,10 +780,9 @@ def show_export_options(df):
     
     with col2:
         # Export to CSV
-        csv = df.to_csv(index=False)
         st.download_button(
             label="📄 Download CSV",
-            data=csv,
+            data=build_csv_bytes(df),
             file_name=f"invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
             mime="text/csv",
             use_container_width=True
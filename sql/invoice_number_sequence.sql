@@ -0,0 +1,11 @@
+-- Global invoice number sequence used by utils/invoice_data.py
+-- (allocate_invoice_sequence / get_preview_bundle).
+--
+-- One row per sequence name; seq is bumped atomically with
+--   UPDATE ... SET seq = LAST_INSERT_ID(seq + 1) WHERE name = 'purchase_invoice'
+-- so concurrent creators never receive the same number. The app does not create
+-- the row itself: the seed below starts it at MAX(purchase_invoices.id), and
+-- invoice creation fails until this script has been applied.
+CREATE TABLE IF NOT EXISTS invoice_number_sequence (name VARCHAR(32) NOT NULL PRIMARY KEY, seq BIGINT NOT NULL) ENGINE = InnoDB;
+INSERT IGNORE INTO invoice_number_sequence (name, seq)
+SELECT 'purchase_invoice', COALESCE(MAX(id), 0) FROM purchase_invoices;
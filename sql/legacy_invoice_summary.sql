@@ -0,0 +1,118 @@
+-- Pre-aggregated legacy invoice quantities per PO line, read by
+-- utils/invoice_data.py (get_uninvoiced_ans, get_po_line_summary).
+--
+-- Legacy invoice lines are purchase_invoice_details rows without an
+-- arrival_detail_id. The summary is kept current by triggers on
+-- purchase_invoice_details and on purchase_invoices (void / restore), so page
+-- loads join one row per PO line instead of re-aggregating the detail table.
+
+CREATE TABLE IF NOT EXISTS mv_legacy_invoice_summary (
+    product_purchase_order_id BIGINT NOT NULL PRIMARY KEY,
+    legacy_invoice_qty DECIMAL(18,4) NOT NULL DEFAULT 0,
+    legacy_invoice_count INT NOT NULL DEFAULT 0
+) ENGINE = InnoDB;
+
+DELIMITER $$
+
+-- Recompute one PO line from the live rows
+DROP PROCEDURE IF EXISTS refresh_legacy_invoice_summary$$
+CREATE PROCEDURE refresh_legacy_invoice_summary(IN p_ppo_id BIGINT)
+BEGIN
+    IF p_ppo_id IS NOT NULL THEN
+        INSERT INTO mv_legacy_invoice_summary (product_purchase_order_id, legacy_invoice_qty, legacy_invoice_count)
+        SELECT
+            p_ppo_id,
+            COALESCE(SUM(pid.purchased_invoice_quantity), 0),
+            COUNT(DISTINCT pid.purchase_invoice_id)
+        FROM purchase_invoice_details pid
+        JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
+        WHERE pid.product_purchase_order_id = p_ppo_id
+            AND pid.arrival_detail_id IS NULL
+            AND pid.delete_flag = 0
+            AND pi.delete_flag = 0
+        ON DUPLICATE KEY UPDATE
+            legacy_invoice_qty = VALUES(legacy_invoice_qty),
+            legacy_invoice_count = VALUES(legacy_invoice_count);
+    END IF;
+END$$
+
+DROP TRIGGER IF EXISTS trg_pid_legacy_summary_ai$$
+CREATE TRIGGER trg_pid_legacy_summary_ai
+AFTER INSERT ON purchase_invoice_details
+FOR EACH ROW
+BEGIN
+    IF NEW.arrival_detail_id IS NULL THEN
+        CALL refresh_legacy_invoice_summary(NEW.product_purchase_order_id);
+    END IF;
+END$$
+
+DROP TRIGGER IF EXISTS trg_pid_legacy_summary_au$$
+CREATE TRIGGER trg_pid_legacy_summary_au
+AFTER UPDATE ON purchase_invoice_details
+FOR EACH ROW
+BEGIN
+    IF OLD.arrival_detail_id IS NULL THEN
+        CALL refresh_legacy_invoice_summary(OLD.product_purchase_order_id);
+    END IF;
+    IF NEW.arrival_detail_id IS NULL
+        AND NOT (OLD.arrival_detail_id IS NULL AND OLD.product_purchase_order_id <=> NEW.product_purchase_order_id) THEN
+        CALL refresh_legacy_invoice_summary(NEW.product_purchase_order_id);
+    END IF;
+END$$
+
+DROP TRIGGER IF EXISTS trg_pid_legacy_summary_ad$$
+CREATE TRIGGER trg_pid_legacy_summary_ad
+AFTER DELETE ON purchase_invoice_details
+FOR EACH ROW
+BEGIN
+    IF OLD.arrival_detail_id IS NULL THEN
+        CALL refresh_legacy_invoice_summary(OLD.product_purchase_order_id);
+    END IF;
+END$$
+
+-- Voiding or restoring an invoice changes which of its legacy lines count
+DROP TRIGGER IF EXISTS trg_pi_legacy_summary_au$$
+CREATE TRIGGER trg_pi_legacy_summary_au
+AFTER UPDATE ON purchase_invoices
+FOR EACH ROW
+BEGIN
+    DECLARE done INT DEFAULT 0;
+    DECLARE v_ppo_id BIGINT;
+    DECLARE legacy_lines CURSOR FOR
+        SELECT DISTINCT product_purchase_order_id
+        FROM purchase_invoice_details
+        WHERE purchase_invoice_id = NEW.id
+            AND arrival_detail_id IS NULL;
+    DECLARE CONTINUE HANDLER FOR NOT FOUND SET done = 1;
+
+    IF NOT (OLD.delete_flag <=> NEW.delete_flag) THEN
+        OPEN legacy_lines;
+        refresh_loop: LOOP
+            FETCH legacy_lines INTO v_ppo_id;
+            IF done THEN
+                LEAVE refresh_loop;
+            END IF;
+            CALL refresh_legacy_invoice_summary(v_ppo_id);
+        END LOOP;
+        CLOSE legacy_lines;
+    END IF;
+END$$
+
+DELIMITER ;
+
+-- Initial backfill
+INSERT INTO mv_legacy_invoice_summary (product_purchase_order_id, legacy_invoice_qty, legacy_invoice_count)
+SELECT
+    pid.product_purchase_order_id,
+    SUM(pid.purchased_invoice_quantity),
+    COUNT(DISTINCT pid.purchase_invoice_id)
+FROM purchase_invoice_details pid
+JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
+WHERE pid.arrival_detail_id IS NULL
+    AND pid.delete_flag = 0
+    AND pi.delete_flag = 0
+    AND pid.product_purchase_order_id IS NOT NULL
+GROUP BY pid.product_purchase_order_id
+ON DUPLICATE KEY UPDATE
+    legacy_invoice_qty = VALUES(legacy_invoice_qty),
+    legacy_invoice_count = VALUES(legacy_invoice_count);
@@ -44,7 +44,7 @@ def get_latest_exchange_rate(from_currency: str, to_currency: str) -> Optional[f
         api_key = os.getenv('EXCHANGE_RATE_API_KEY')
         if not api_key:
             logger.warning("No API key found, falling back to database")
-            return get_rate_from_database(from_currency, to_currency)
+            return get_cached_rate_from_database(from_currency, to_currency, cache_key, now)
         
         # API supports all currency conversions
         url = f"http://api.exchangeratesapi.io/v1/convert?access_key={api_key}&from={from_currency}&to={to_currency}&amount=1"
@@ -71,7 +71,15 @@ def get_latest_exchange_rate(from_currency: str, to_currency: str) -> Optional[f
         logger.error(f"Error fetching exchange rate from API: {e}")
     
     # Fallback to database
-    return get_rate_from_database(from_currency, to_currency)
+    return get_cached_rate_from_database(from_currency, to_currency, cache_key, now)
+
+def get_cached_rate_from_database(from_currency: str, to_currency: str, cache_key: str, now: datetime) -> Optional[float]:
+    """Database fallback rate; only a rate actually found is cached (1 hour)"""
+    rate = get_rate_from_database(from_currency, to_currency)
+    if rate is not None:
+        _rate_cache[cache_key] = rate
+        _cache_expiry[cache_key] = now + timedelta(hours=1)
+    return rate
 
 def get_rate_from_database(from_currency: str, to_currency: str) -> Optional[float]:
     """Get latest exchange rate from database"""
@@ -162,6 +170,28 @@ def get_available_currencies() -> pd.DataFrame:
         # Return empty DataFrame instead of defaults
         return pd.DataFrame()
 
+def get_currency_lookup() -> Tuple[List[str], List[str], Dict[str, int]]:
+    """
+    Get currency codes, "CODE - Name" labels and a code -> id map
+    
+    Derived once from get_available_currencies so callers don't rescan the DataFrame.
+    An empty result (failed load) is not kept, so the next rerun queries again.
+    """
+    df = get_available_currencies()
+    if df.empty:
+        get_available_currencies.clear()
+        return [], [], {}
+    
+    return build_currency_lookup(df)
+
+@st.cache_data(ttl=3600, show_spinner=False)  # Cache for 1 hour
+def build_currency_lookup(df: pd.DataFrame) -> Tuple[List[str], List[str], Dict[str, int]]:
+    """Build the get_currency_lookup tuple from the currencies DataFrame"""
+    codes = df['code'].tolist()
+    labels = (df['code'] + ' - ' + df['name']).tolist()
+    code_to_id = {code: int(currency_id) for code, currency_id in zip(codes, df['id'])}
+    return codes, labels, code_to_id
+
 def calculate_exchange_rates(po_currency_code: str, invoice_currency_code: str) -> Dict[str, Optional[float]]:
     """
     Calculate all necessary exchange rates for invoice
@@ -250,7 +280,8 @@ def format_exchange_rate(rate: Optional[float]) -> str:
 def get_invoice_amounts_in_currency(
     selected_df: pd.DataFrame, 
     po_currency: str, 
-    invoice_currency: str
+    invoice_currency: str,
+    exchange_rate: Optional[float] = None
 ) -> Optional[Dict[str, float]]:
     """
     Calculate invoice amounts in the selected invoice currency
@@ -259,6 +290,7 @@ def get_invoice_amounts_in_currency(
         selected_df: DataFrame with selected invoice lines
         po_currency: Original PO currency code
         invoice_currency: Selected invoice currency code
+        exchange_rate: Already fetched PO/invoice currency rate (looked up if None)
         
     Returns:
         Dictionary with converted amounts or None if exchange rate unavailable
@@ -266,7 +298,7 @@ def get_invoice_amounts_in_currency(
     if po_currency == invoice_currency:
         # No conversion needed
         exchange_rate = 1.0
-    else:
+    elif exchange_rate is None:
         exchange_rate = get_latest_exchange_rate(po_currency, invoice_currency)
         
         # Return None if exchange rate is not available
@@ -274,31 +306,20 @@ def get_invoice_amounts_in_currency(
             logger.error(f"Cannot calculate amounts: No exchange rate for {po_currency}/{invoice_currency}")
             return None
     
-    total_amount = 0
-    total_vat = 0
+    def column(name, default):
+        return selected_df[name] if name in selected_df.columns else pd.Series(default, index=selected_df.index)
     
-    for _, row in selected_df.iterrows():
-        # Extract unit cost (assuming format "123.45 USD")
-        cost_str = str(row.get('buying_unit_cost', '0'))
-        if ' ' in cost_str:
-            unit_cost = float(cost_str.split()[0])
-        else:
-            unit_cost = float(cost_str)
-        
-        quantity = row.get('uninvoiced_quantity', 0)
-        vat_percent = row.get('vat_percent', 0)
-        
-        # Calculate line amount in original currency
-        line_amount = unit_cost * quantity
-        
-        # Convert to invoice currency
-        line_amount_converted = line_amount * exchange_rate
-        
-        # Calculate VAT
-        vat_amount = line_amount_converted * vat_percent / 100
-        
-        total_amount += line_amount_converted
-        total_vat += vat_amount
+    # Extract unit cost (assuming format "123.45 USD")
+    unit_costs = column('buying_unit_cost', '0').astype(str).str.split().str[0].astype(float)
+    
+    # Calculate line amounts in original currency, then convert to invoice currency
+    line_amounts_converted = unit_costs * column('uninvoiced_quantity', 0) * exchange_rate
+    
+    # Calculate VAT
+    vat_amounts = line_amounts_converted * column('vat_percent', 0) / 100
+    
+    total_amount = float(line_amounts_converted.sum())
+    total_vat = float(vat_amounts.sum())
     
     return {
         'exchange_rate': exchange_rate,
@@ -3,14 +3,16 @@
 import pandas as pd
 from sqlalchemy import create_engine
 from urllib.parse import quote_plus
+from functools import lru_cache
 import logging
-from .config import DB_CONFIG
+from .config import DB_CONFIG, APP_CONFIG
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=1)
 def get_db_engine():
-    """Create and return SQLAlchemy database engine"""
+    """Create the shared SQLAlchemy engine (one pooled engine per process)"""
     logger.info("🔌 Connecting to database...")
 
     user = DB_CONFIG["user"]
@@ -22,4 +24,11 @@ def get_db_engine():
     url = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}"
     logger.info(f"🔐 Using SQLAlchemy URL: mysql+pymysql://{user}:***@{host}:{port}/{database}")
 
-    return create_engine(url)
\ No newline at end of file
+    # Reuse pooled connections across calls; pre-ping drops connections the server closed
+    return create_engine(
+        url,
+        pool_size=APP_CONFIG["DB_POOL_SIZE"],
+        max_overflow=APP_CONFIG["DB_MAX_OVERFLOW"],
+        pool_recycle=APP_CONFIG["DB_POOL_RECYCLE"],
+        pool_pre_ping=True
+    )
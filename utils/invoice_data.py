@@ -2,7 +2,8 @@
 # Complete implementation with all invoice management functions
 
 import pandas as pd
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import ProgrammingError
 import streamlit as st
 from datetime import datetime, date, timedelta
 import logging
@@ -12,33 +13,127 @@ import re
 
 logger = logging.getLogger(__name__)
 
+# Low-cardinality text columns of get_uninvoiced_ans, stored as pandas categoricals
+CATEGORICAL_COLUMNS = [
+    'vendor_code', 'vendor', 'vendor_type', 'po_number', 'po_type', 'payment_term', 'po_line_status',
+    'buying_uom', 'pt_code', 'brand', 'currency', 'invoice_status', 'has_legacy_invoices'
+]
+
+# Numeric columns of get_uninvoiced_ans; MySQL DECIMALs arrive as Python Decimal objects
+NUMERIC_COLUMNS = [
+    'arrival_quantity', 'uninvoiced_quantity', 'total_invoiced_quantity', 'estimated_invoice_value',
+    'vat_percent', 'vat_amount', 'po_line_arrival_completion_percent', 'po_line_invoice_completion_percent',
+    'po_line_pending_invoiced_qty', 'po_buying_quantity', 'po_standard_quantity', 'legacy_invoice_qty',
+    'true_remaining_qty', 'landed_cost', 'landed_cost_usd'
+]
+
+# Small integer counters of get_uninvoiced_ans, downcast to the narrowest integer type
+COUNT_COLUMNS = ['days_since_arrival', 'legacy_invoice_count']
+
+# get_uninvoiced_ans list filters: filter key -> column matched with IN
+UNINVOICED_LIST_FILTERS = {
+    'creators': 'can.creator',
+    'vendor_types': 'can.vendor_type',
+    'vendors': 'can.vendor_code',
+    'entities': 'can.consignee_code',
+    'brands': 'can.brand',
+    'an_numbers': 'can.arrival_note_number',
+    'po_numbers': 'can.po_number'
+}
+
+# get_uninvoiced_ans date range filters: filter key -> condition
+UNINVOICED_RANGE_FILTERS = {
+    'arrival_date_from': 'can.arrival_date >= :arrival_date_from',
+    'arrival_date_to': 'can.arrival_date <= :arrival_date_to',
+    'created_date_from': 'can.created_date >= :created_date_from',
+    'created_date_to': 'can.created_date <= :created_date_to'
+}
+
+# Rows per chunk when streaming the full get_uninvoiced_ans result
+UNINVOICED_CHUNK_SIZE = 20000
+
+# Low-cardinality text columns of get_recent_invoices, stored as pandas categoricals
+INVOICE_CATEGORICAL_COLUMNS = ['currency', 'invoice_type', 'vendor', 'payment_status']
+
+# Legacy invoice quantities per PO line (invoice lines without arrival_detail_id): the
+# trigger-maintained summary table (sql/legacy_invoice_summary.sql), or the same
+# aggregate computed inline while that script has not been applied
+LEGACY_INVOICE_SUMMARY_TABLE = 'mv_legacy_invoice_summary'
+LEGACY_INVOICE_SUMMARY_INLINE = """(
+    SELECT 
+        pid.product_purchase_order_id,
+        SUM(pid.purchased_invoice_quantity) as legacy_invoice_qty,
+        COUNT(DISTINCT pid.purchase_invoice_id) as legacy_invoice_count
+    FROM purchase_invoice_details pid
+    JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
+    WHERE pid.arrival_detail_id IS NULL  -- Legacy invoices only
+        AND pid.delete_flag = 0
+        AND pi.delete_flag = 0
+    GROUP BY pid.product_purchase_order_id
+)"""
+LEGACY_INVOICE_SUMMARY_CHECK = text(f"SELECT 1 FROM {LEGACY_INVOICE_SUMMARY_TABLE} LIMIT 1")
+
 # ============================================================================
 # CORE INVOICE DATA FUNCTIONS
 # ============================================================================
 
-@st.cache_data(ttl=300)  # Cache for 5 minutes
+def get_filters_key(filters: Optional[Dict]) -> Tuple:
+    """
+    Canonical, hashable form of a filter dict
+    
+    Empty values are dropped and list values sorted, so equivalent filter sets share a cache entry.
+    """
+    if not filters:
+        return ()
+    return tuple(sorted(
+        (key, tuple(sorted(value)) if isinstance(value, (list, tuple, set)) else value)
+        for key, value in filters.items()
+        if value
+    ))
+
+@st.cache_data(ttl=300, show_spinner=False)  # Re-check every 5 minutes
+def get_legacy_invoice_source() -> str:
+    """
+    SQL source for legacy invoice quantities (joined as `li` on product_purchase_order_id)
+    
+    Uses the summary table when it exists; otherwise logs an error and falls back to the
+    inline aggregate so the pages keep working.
+    """
+    try:
+        with get_db_engine().connect() as conn:
+            conn.execute(LEGACY_INVOICE_SUMMARY_CHECK)
+        return LEGACY_INVOICE_SUMMARY_TABLE
+    except ProgrammingError as e:
+        logger.error(
+            f"{LEGACY_INVOICE_SUMMARY_TABLE} is missing, apply sql/legacy_invoice_summary.sql; "
+            f"computing legacy invoices inline: {e}"
+        )
+        return LEGACY_INVOICE_SUMMARY_INLINE
+
 def get_uninvoiced_ans(filters: Dict = None) -> pd.DataFrame:
     """
     Get all ANs with uninvoiced quantity
     Enhanced with PO level data and legacy invoice detection
     """
+    return load_uninvoiced_ans(get_filters_key(filters))
+
+@st.cache_data(ttl=300)  # Cache for 5 minutes
+def load_uninvoiced_ans(filters_key: Tuple) -> pd.DataFrame:
+    """Cached query behind get_uninvoiced_ans, keyed by get_filters_key; rows indexed by can_line_id"""
+    filters = dict(filters_key)
     try:
         engine = get_db_engine()
         
-        # Enhanced query with legacy invoice detection
+        # Enhanced query with legacy invoice detection; legacy quantities (invoice lines
+        # without arrival_detail_id) come from get_legacy_invoice_source
         query = """
-        WITH legacy_invoices AS (
-            -- Calculate legacy invoices per PO line (arrival_detail_id IS NULL)
+        WITH parsed_can AS (
+            -- Split "123.45 USD" once per row instead of in every expression below
             SELECT 
-                pid.product_purchase_order_id,
-                SUM(pid.purchased_invoice_quantity) as legacy_invoice_qty,
-                COUNT(DISTINCT pid.purchase_invoice_id) as legacy_invoice_count
-            FROM purchase_invoice_details pid
-            JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
-            WHERE pid.arrival_detail_id IS NULL  -- Legacy invoices only
-                AND pid.delete_flag = 0
-                AND pi.delete_flag = 0
-            GROUP BY pid.product_purchase_order_id
+                v.*,
+                CAST(SUBSTRING_INDEX(v.buying_unit_cost, ' ', 1) AS DECIMAL(15,2)) AS unit_cost_value,
+                SUBSTRING_INDEX(v.buying_unit_cost, ' ', -1) AS unit_cost_currency
+            FROM can_tracking_full_view v
         )
         SELECT 
             -- AN/CAN Info
@@ -88,17 +183,14 @@ def get_uninvoiced_ans(filters: Dict = None) -> pd.DataFrame:
             can.landed_cost_usd,
             
             -- Calculate invoice value
-            ROUND(can.uninvoiced_quantity * 
-                  CAST(SUBSTRING_INDEX(can.buying_unit_cost, ' ', 1) AS DECIMAL(15,2)), 2
-            ) AS estimated_invoice_value,
+            ROUND(can.uninvoiced_quantity * can.unit_cost_value, 2) AS estimated_invoice_value,
 
             -- Extract currency
-            SUBSTRING_INDEX(can.buying_unit_cost, ' ', -1) AS currency,
+            can.unit_cost_currency AS currency,
             
             -- VAT information
             COALESCE(ppo.vat_gst, 0) AS vat_percent,
-            ROUND(can.uninvoiced_quantity * 
-                  CAST(SUBSTRING_INDEX(can.buying_unit_cost, ' ', 1) AS DECIMAL(15,2)) * 
+            ROUND(can.uninvoiced_quantity * can.unit_cost_value * 
                   COALESCE(ppo.vat_gst, 0) / 100, 2
             ) AS vat_amount,
             
@@ -133,60 +225,29 @@ def get_uninvoiced_ans(filters: Dict = None) -> pd.DataFrame:
                 ELSE 'N' 
             END AS has_legacy_invoices
             
-        FROM can_tracking_full_view can
+        FROM parsed_can can
         JOIN product_purchase_orders ppo ON can.product_purchase_order_id = ppo.id
-        LEFT JOIN legacy_invoices li ON li.product_purchase_order_id = ppo.id
+        LEFT JOIN {legacy_source} li ON li.product_purchase_order_id = ppo.id
         WHERE can.uninvoiced_quantity > 0
-        """
+        """.format(legacy_source=get_legacy_invoice_source())
         
         # Add filters
         conditions = []
         params = {}
         
         if filters:
-            if filters.get('creators'):
-                conditions.append("can.creator IN :creators")
-                params['creators'] = tuple(filters['creators'])
-            
-            if filters.get('vendor_types'):
-                conditions.append("can.vendor_type IN :vendor_types")
-                params['vendor_types'] = tuple(filters['vendor_types'])
-            
-            if filters.get('vendors'):
-                conditions.append("can.vendor_code IN :vendors")
-                params['vendors'] = tuple(filters['vendors'])
-            
-            if filters.get('entities'):
-                conditions.append("can.consignee_code IN :entities")
-                params['entities'] = tuple(filters['entities'])
-            
-            if filters.get('brands'):
-                conditions.append("can.brand IN :brands")
-                params['brands'] = tuple(filters['brands'])
+            for key, column in UNINVOICED_LIST_FILTERS.items():
+                if filters.get(key):
+                    conditions.append(f"{column} IN :{key}")
+                    params[key] = tuple(filters[key])
             
-            if filters.get('arrival_date_from'):
-                conditions.append("can.arrival_date >= :arrival_date_from")
-                params['arrival_date_from'] = filters['arrival_date_from']
+            for key, condition in UNINVOICED_RANGE_FILTERS.items():
+                if filters.get(key):
+                    conditions.append(condition)
+                    params[key] = filters[key]
             
-            if filters.get('arrival_date_to'):
-                conditions.append("can.arrival_date <= :arrival_date_to")
-                params['arrival_date_to'] = filters['arrival_date_to']
-            
-            if filters.get('created_date_from'):
-                conditions.append("can.created_date >= :created_date_from")
-                params['created_date_from'] = filters['created_date_from']
-            
-            if filters.get('created_date_to'):
-                conditions.append("can.created_date <= :created_date_to")
-                params['created_date_to'] = filters['created_date_to']
-            
-            if filters.get('an_numbers'):
-                conditions.append("can.arrival_note_number IN :an_numbers")
-                params['an_numbers'] = tuple(filters['an_numbers'])
-            
-            if filters.get('po_numbers'):
-                conditions.append("can.po_number IN :po_numbers")
-                params['po_numbers'] = tuple(filters['po_numbers'])
+            if filters.get('hide_completed_po_lines'):
+                conditions.append("can.po_line_pending_invoiced_qty > 0")
         
         # Add conditions to query
         if conditions:
@@ -194,9 +255,26 @@ def get_uninvoiced_ans(filters: Dict = None) -> pd.DataFrame:
         
         query += " ORDER BY can.arrival_date DESC, can.arrival_note_number DESC"
         
+        # List filters bind as expanding parameters
+        statement = text(query).bindparams(*[
+            bindparam(key, expanding=True) for key in UNINVOICED_LIST_FILTERS if key in params
+        ])
+        
         # Execute query
         with engine.connect() as conn:
-            df = pd.read_sql(text(query), conn, params=params)
+            # Stream the result from a server-side cursor in chunks rather than
+            # buffering every row in the driver before pandas builds the frame
+            chunks = pd.read_sql(
+                statement, conn.execution_options(stream_results=True),
+                params=params, chunksize=UNINVOICED_CHUNK_SIZE
+            )
+            df = pd.concat(chunks, copy=False, ignore_index=True)
+        
+        df = _downcast_frame(df)
+        
+        # Indexed by can_line_id (kept as a column too) for selection lookups
+        if 'can_line_id' in df.columns:
+            df = df.set_index('can_line_id', drop=False)
         
         return df
         
@@ -204,43 +282,89 @@ def get_uninvoiced_ans(filters: Dict = None) -> pd.DataFrame:
         logger.error(f"Error fetching uninvoiced ANs: {e}")
         return pd.DataFrame()
 
-@st.cache_data(ttl=60)
+def _downcast_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compact dtypes for the uninvoiced AN frame
+    
+    Repeated strings become categories and Decimal objects become float64 (kept at
+    full width, these are money and quantities). Columns that don't parse are left as is.
+    """
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            try:
+                df[col] = pd.to_numeric(df[col]).astype('float64')
+            except (ValueError, TypeError):
+                pass
+    
+    for col in COUNT_COLUMNS:
+        if col in df.columns:
+            try:
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            except (ValueError, TypeError):
+                pass
+    
+    return df
+
+# Distinct values per option instead of distinct 10-column combinations;
+# the CTE is referenced several times, so the view is materialized once.
+# Rows come back sorted, so each option list is built in order
+FILTER_OPTIONS_QUERY = text("""
+WITH base AS (
+    SELECT 
+        creator,
+        vendor_type,
+        vendor_code,
+        vendor,
+        consignee_code,
+        consignee,
+        brand,
+        arrival_note_number,
+        po_number,
+        po_line_status
+    FROM can_tracking_full_view
+    WHERE uninvoiced_quantity > 0
+)
+SELECT DISTINCT 'creators' AS option_key, creator AS option_value, NULL AS option_label FROM base
+UNION ALL
+SELECT DISTINCT 'vendor_types', vendor_type, NULL FROM base
+UNION ALL
+SELECT DISTINCT 'vendors', vendor_code, vendor FROM base
+UNION ALL
+SELECT DISTINCT 'entities', consignee_code, consignee FROM base
+UNION ALL
+SELECT DISTINCT 'brands', brand, NULL FROM base
+UNION ALL
+SELECT DISTINCT 'an_numbers', arrival_note_number, NULL FROM base
+UNION ALL
+SELECT DISTINCT 'po_numbers', po_number, NULL FROM base
+UNION ALL
+SELECT DISTINCT 'po_line_statuses', po_line_status, NULL FROM base
+ORDER BY option_key, option_value, option_label
+""")
+
+@st.cache_data(ttl=300, show_spinner=False)  # Cache for 5 minutes
 def get_filter_options() -> Dict:
     """Get unique values for filters"""
     try:
         engine = get_db_engine()
         
-        query = text("""
-        SELECT 
-            DISTINCT creator,
-            vendor_type,
-            vendor_code,
-            vendor,
-            consignee_code,
-            consignee,
-            brand,
-            arrival_note_number,
-            po_number,
-            po_line_status
-        FROM can_tracking_full_view
-        WHERE uninvoiced_quantity > 0
-        """)
-        
         with engine.connect() as conn:
-            df = pd.read_sql(query, conn)
+            rows = conn.execute(FILTER_OPTIONS_QUERY).fetchall()
         
         options = {
-            'creators': sorted(df['creator'].dropna().unique().tolist()),
-            'vendor_types': sorted(df['vendor_type'].dropna().unique().tolist()),
-            'vendors': sorted([(row['vendor_code'], row['vendor']) 
-                              for _, row in df[['vendor_code', 'vendor']].drop_duplicates().iterrows()]),
-            'entities': sorted([(row['consignee_code'], row['consignee']) 
-                               for _, row in df[['consignee_code', 'consignee']].drop_duplicates().iterrows()]),
-            'brands': sorted(df['brand'].dropna().unique().tolist()),
-            'an_numbers': sorted(df['arrival_note_number'].dropna().unique().tolist()),
-            'po_numbers': sorted(df['po_number'].dropna().unique().tolist()),
-            'po_line_statuses': sorted(df['po_line_status'].dropna().unique().tolist())
+            'creators': [], 'vendor_types': [], 'vendors': [], 'entities': [],
+            'brands': [], 'an_numbers': [], 'po_numbers': [], 'po_line_statuses': []
         }
+        for key, value, label in rows:
+            if key in ('vendors', 'entities'):
+                # (code, name) pairs
+                options[key].append((value, label))
+            elif value is not None:
+                options[key].append(value)
         
         return options
         
@@ -251,104 +375,136 @@ def get_filter_options() -> Dict:
             'brands': [], 'an_numbers': [], 'po_numbers': [], 'po_line_statuses': []
         }
 
-def get_invoice_details(can_line_ids: List[int]) -> pd.DataFrame:
+# Detail query for selected CAN lines; get_preview_bundle appends the next
+# invoice sequence as an extra column to save a second round trip
+INVOICE_DETAILS_QUERY = """
+SELECT 
+    ad.id AS can_line_id,
+    ad.id AS arrival_detail_id,
+    
+    -- Direct FK from arrival_details (CORRECT!)
+    ad.product_purchase_order_id,
+    ppo.purchase_order_id,
+    
+    -- AN Info
+    a.arrival_note_number,
+    
+    -- PO Info
+    po.po_number,
+    po.currency_id AS po_currency_id,
+    c.code AS po_currency_code,
+    po.seller_company_id AS vendor_id,
+    po.buyer_company_id AS entity_id,
+    po.payment_term_id,
+    
+    -- Payment Terms
+    pt.name AS payment_term_name,
+    
+    -- Product Info (from ppo, not from can_tracking_full_view)
+    p.name AS product_name,
+    p.pt_code,
+    
+    -- Vendor Info
+    seller.english_name AS vendor,
+    seller.company_code AS vendor_code,
+    
+    -- Quantity & Cost
+    ad.arrival_quantity AS uninvoiced_quantity,
+    ppo.purchaseuom AS buying_uom,
+    CONCAT(
+        ROUND(ppo.purchase_unit_cost, 2), 
+        ' ', 
+        c.code
+    ) AS buying_unit_cost,
+    
+    -- Payment term from view (for compatibility)
+    pt.name AS payment_term{extra_columns}
+    
+FROM arrival_details ad
+
+-- Core joins using direct FKs (CORRECT PATH)
+INNER JOIN arrivals a 
+    ON a.id = ad.arrival_id 
+    AND a.delete_flag = 0
+
+INNER JOIN product_purchase_orders ppo 
+    ON ppo.id = ad.product_purchase_order_id  -- Direct FK!
+    AND ppo.delete_flag = 0
+
+INNER JOIN purchase_orders po 
+    ON po.id = ppo.purchase_order_id
+    AND po.delete_flag = 0
+
+INNER JOIN products p 
+    ON p.id = ppo.product_id
+
+INNER JOIN companies seller 
+    ON seller.id = po.seller_company_id
+
+INNER JOIN currencies c 
+    ON c.id = po.currency_id
+
+LEFT JOIN payment_terms pt 
+    ON pt.id = po.payment_term_id
+
+WHERE ad.id IN :can_line_ids
+    AND ad.delete_flag = 0
+
+ORDER BY a.arrival_note_number, ad.id
+"""
+
+PREVIEW_BUNDLE_STATEMENT = text(
+    INVOICE_DETAILS_QUERY.format(extra_columns=""",
+    
+    -- Next invoice sequence for the preview number (peek only; allocated on create)
+    (SELECT seq + 1 FROM invoice_number_sequence WHERE name = :sequence_name) AS next_invoice_seq""")
+).bindparams(bindparam('can_line_ids', expanding=True))
+
+@st.cache_data(ttl=60)
+def get_preview_bundle(can_line_ids: Tuple[int, ...], is_advance_payment: bool = False) -> Tuple[pd.DataFrame, Optional[str]]:
     """
-    Get detailed information for selected CAN lines
+    Get invoice details and the proposed invoice number in a single query
+    
+    Returns:
+        (details_df, invoice_number) - invoice_number is None if no details were found
     
-    CRITICAL FIX: Use direct FK from arrival_details.product_purchase_order_id
-    instead of complex join via products table which causes wrong mapping
+    Raises:
+        ValueError: the invoice number sequence table or row is missing
     """
     try:
         engine = get_db_engine()
         
-        # FIXED QUERY - Use direct FKs, no complex product matching
-        query = """
-        SELECT 
-            ad.id AS can_line_id,
-            ad.id AS arrival_detail_id,
-            
-            -- Direct FK from arrival_details (CORRECT!)
-            ad.product_purchase_order_id,
-            ppo.purchase_order_id,
-            
-            -- AN Info
-            a.arrival_note_number,
-            
-            -- PO Info
-            po.po_number,
-            po.currency_id AS po_currency_id,
-            c.code AS po_currency_code,
-            po.seller_company_id AS vendor_id,
-            po.buyer_company_id AS entity_id,
-            po.payment_term_id,
-            
-            -- Payment Terms
-            pt.name AS payment_term_name,
-            
-            -- Product Info (from ppo, not from can_tracking_full_view)
-            p.name AS product_name,
-            p.pt_code,
-            
-            -- Vendor Info
-            seller.english_name AS vendor,
-            seller.company_code AS vendor_code,
-            
-            -- Quantity & Cost
-            ad.arrival_quantity AS uninvoiced_quantity,
-            ppo.purchaseuom AS buying_uom,
-            CONCAT(
-                ROUND(ppo.purchase_unit_cost, 2), 
-                ' ', 
-                c.code
-            ) AS buying_unit_cost,
-            
-            -- Payment term from view (for compatibility)
-            pt.name AS payment_term
-            
-        FROM arrival_details ad
-        
-        -- Core joins using direct FKs (CORRECT PATH)
-        INNER JOIN arrivals a 
-            ON a.id = ad.arrival_id 
-            AND a.delete_flag = 0
-        
-        INNER JOIN product_purchase_orders ppo 
-            ON ppo.id = ad.product_purchase_order_id  -- Direct FK!
-            AND ppo.delete_flag = 0
-        
-        INNER JOIN purchase_orders po 
-            ON po.id = ppo.purchase_order_id
-            AND po.delete_flag = 0
-        
-        INNER JOIN products p 
-            ON p.id = ppo.product_id
-        
-        INNER JOIN companies seller 
-            ON seller.id = po.seller_company_id
-        
-        INNER JOIN currencies c 
-            ON c.id = po.currency_id
-        
-        LEFT JOIN payment_terms pt 
-            ON pt.id = po.payment_term_id
-        
-        WHERE ad.id IN :can_line_ids
-            AND ad.delete_flag = 0
+        params = {'can_line_ids': tuple(can_line_ids), 'sequence_name': INVOICE_SEQUENCE_NAME}
+        with engine.connect() as conn:
+            df = pd.read_sql(PREVIEW_BUNDLE_STATEMENT, conn, params=params)
         
-        ORDER BY a.arrival_note_number, ad.id
-        """
+        if df.empty:
+            return df, None
         
-        with engine.connect() as conn:
-            df = pd.read_sql(text(query), conn, params={'can_line_ids': tuple(can_line_ids)})
+        seq = df.pop('next_invoice_seq').iloc[0]
+        if pd.isna(seq):
+            raise ValueError(INVOICE_SEQUENCE_MISSING)
+        seq = int(seq)
+        df = df.drop_duplicates(subset=['arrival_detail_id']).reset_index(drop=True)
+        df['payment_term_days'] = calculate_days_from_term_names(df['payment_term_name'])
         
-        if not df.empty:
-            df['payment_term_days'] = df['payment_term_name'].apply(calculate_days_from_term_name)
+        invoice_number = format_invoice_number(
+            df['vendor_id'].iloc[0], df['entity_id'].iloc[0], seq, is_advance_payment
+        )
         
-        return df
+        return df, invoice_number
         
+    except ValueError:
+        raise
+    except ProgrammingError as e:
+        if 'invoice_number_sequence' in str(e):
+            logger.error(f"{INVOICE_SEQUENCE_MISSING}: {e}")
+            raise ValueError(INVOICE_SEQUENCE_MISSING) from e
+        logger.error(f"Error getting invoice preview data: {e}")
+        return pd.DataFrame(), None
     except Exception as e:
-        logger.error(f"Error getting invoice details: {e}")
-        return pd.DataFrame()
+        logger.error(f"Error getting invoice preview data: {e}")
+        return pd.DataFrame(), None
 
 def validate_invoice_selection(selected_df: pd.DataFrame) -> Tuple[bool, str]:
     """
@@ -377,20 +533,82 @@ def validate_invoice_selection(selected_df: pd.DataFrame) -> Tuple[bool, str]:
     
     return True, ""
 
+# VAT percentage per PO line
+PPO_VAT_QUERY = text("""
+SELECT id, vat_gst 
+FROM product_purchase_orders 
+WHERE id IN :ppo_ids 
+AND delete_flag = 0
+""").bindparams(bindparam('ppo_ids', expanding=True))
+
+# Invoice line insert, executed once per invoice with all rows (executemany)
+INVOICE_DETAIL_INSERT = text("""
+INSERT INTO purchase_invoice_details (
+    purchase_invoice_id,
+    purchase_order_id,
+    product_purchase_order_id,
+    arrival_detail_id,
+    purchased_invoice_quantity,
+    invoiced_quantity,
+    amount,
+    amount_exclude_vat,
+    vat_gst,
+    exchange_rate,
+    delete_flag
+) VALUES (
+    :purchase_invoice_id,
+    :purchase_order_id,
+    :product_purchase_order_id,
+    :arrival_detail_id,
+    :purchased_invoice_quantity,
+    :invoiced_quantity,
+    :amount,
+    :amount_exclude_vat,
+    :vat_gst,
+    :exchange_rate,
+    0
+)
+""")
+
+# Attachment link for a created invoice, executed once with all attachments (executemany)
+INVOICE_MEDIA_LINK_INSERT = text("""
+INSERT INTO purchase_invoice_medias (
+    purchase_invoice_id,
+    media_id,
+    created_by,
+    created_date,
+    delete_flag,
+    version
+) VALUES (
+    :purchase_invoice_id,
+    :media_id,
+    :created_by,
+    NOW(),
+    0,
+    0
+)
+""")
+
 def create_purchase_invoice(
     invoice_data: Dict, 
     details_df: pd.DataFrame, 
     keycloak_id: str,
-    media_ids: List[int] = None
+    media_ids: List[int] = None,
+    invoice_number: Optional[str] = None
 ) -> Tuple[bool, str, Optional[int]]:
     """
     Create purchase invoice with proper VAT field handling and optional file attachments
     
+    Unless a number reserved with reserve_invoice_number is passed, the invoice number is
+    allocated inside the insert transaction; on success the final number is written back to
+    invoice_data['invoice_number'] (replacing the preview number).
+    
     Args:
         invoice_data: Invoice header data dictionary
         details_df: DataFrame with invoice line items
         keycloak_id: User's keycloak_id (not username)
         media_ids: Optional list of media IDs to link to invoice
+        invoice_number: Number already reserved for this invoice (e.g. used to name attachments)
         
     Returns:
         Tuple of (success, message, invoice_id)
@@ -399,23 +617,26 @@ def create_purchase_invoice(
     
     try:
         with engine.begin() as conn:
+            # Allocate the invoice number atomically with the insert
+            if invoice_number is None:
+                seq = allocate_invoice_sequence(conn)
+                invoice_number = format_invoice_number(
+                    invoice_data['seller_id'], invoice_data['buyer_id'], seq,
+                    bool(invoice_data.get('advance_payment'))
+                )
+            
             # Calculate total amounts excluding VAT
-            total_amount_exclude_vat = 0
             po_to_invoice_rate = invoice_data.get('po_to_invoice_rate', 1.0)
+            unit_costs = details_df['buying_unit_cost'].str.split().str[0].astype(float)
+            quantities = details_df['uninvoiced_quantity']
             
-            # First pass: calculate totals
-            for _, row in details_df.iterrows():
-                unit_cost_str = row['buying_unit_cost']
-                unit_cost = float(unit_cost_str.split()[0])
-                quantity = row['uninvoiced_quantity']
-                
-                # Calculate base amount in invoice currency (excluding VAT)
-                base_amount_in_invoice_currency = unit_cost * quantity * po_to_invoice_rate
-                total_amount_exclude_vat += base_amount_in_invoice_currency
+            # Base amounts in invoice currency (excluding VAT), reused for the detail lines
+            base_amounts = unit_costs * quantities * po_to_invoice_rate
+            total_amount_exclude_vat = float(base_amounts.sum())
             
             # Prepare header data
             header_params = {
-                'invoice_number': invoice_data['invoice_number'],
+                'invoice_number': invoice_number,
                 'invoiced_date': invoice_data['invoiced_date'],
                 'due_date': invoice_data['due_date'],
                 'total_invoiced_amount': invoice_data['total_invoiced_amount'],
@@ -463,147 +684,114 @@ def create_purchase_invoice(
             invoice_id = result.lastrowid
             
             # Insert purchase_invoice_details with VAT fields
-            for _, row in details_df.iterrows():
-                # Extract unit cost
-                unit_cost_str = row['buying_unit_cost']
-                unit_cost = float(unit_cost_str.split()[0])
-                
-                # Get VAT percentage from product_purchase_orders
-                vat_percent = 0
-                if 'product_purchase_order_id' in row and row['product_purchase_order_id']:
-                    vat_query = text("""
-                    SELECT vat_gst 
-                    FROM product_purchase_orders 
-                    WHERE id = :ppo_id 
-                    AND delete_flag = 0
-                    """)
-                    vat_result = conn.execute(vat_query, {'ppo_id': row['product_purchase_order_id']}).fetchone()
-                    if vat_result and vat_result[0] is not None:
-                        vat_percent = float(vat_result[0])
-                
-                # Calculate amounts
-                quantity = row['uninvoiced_quantity']
-                
-                # Amount excluding VAT in invoice currency
-                amount_exclude_vat = round(unit_cost * quantity * po_to_invoice_rate, 2)
-                
-                # Amount including VAT
-                vat_multiplier = 1 + (vat_percent / 100)
-                amount_include_vat = round(amount_exclude_vat * vat_multiplier, 2)
-                
-                detail_params = {
-                    'purchase_invoice_id': invoice_id,
-                    'purchase_order_id': row['purchase_order_id'],
-                    'product_purchase_order_id': row['product_purchase_order_id'],
-                    'arrival_detail_id': row['arrival_detail_id'],
-                    'purchased_invoice_quantity': quantity,
-                    'invoiced_quantity': quantity,
-                    'amount': amount_include_vat,
-                    'amount_exclude_vat': amount_exclude_vat,
-                    'vat_gst': vat_percent,
-                    'exchange_rate': po_to_invoice_rate
+            # VAT percentages from product_purchase_orders, one query for all lines
+            ppo_ids = details_df['product_purchase_order_id'].dropna().unique().tolist()
+            vat_map = {}
+            if ppo_ids:
+                vat_map = {
+                    ppo_id: float(vat_gst)
+                    for ppo_id, vat_gst in conn.execute(PPO_VAT_QUERY, {'ppo_ids': tuple(ppo_ids)})
+                    if vat_gst is not None
                 }
-                
-                detail_query = text("""
-                INSERT INTO purchase_invoice_details (
-                    purchase_invoice_id,
-                    purchase_order_id,
-                    product_purchase_order_id,
-                    arrival_detail_id,
-                    purchased_invoice_quantity,
-                    invoiced_quantity,
-                    amount,
-                    amount_exclude_vat,
-                    vat_gst,
-                    exchange_rate,
-                    delete_flag
-                ) VALUES (
-                    :purchase_invoice_id,
-                    :purchase_order_id,
-                    :product_purchase_order_id,
-                    :arrival_detail_id,
-                    :purchased_invoice_quantity,
-                    :invoiced_quantity,
-                    :amount,
-                    :amount_exclude_vat,
-                    :vat_gst,
-                    :exchange_rate,
-                    0
-                )
-                """)
-                
-                conn.execute(detail_query, detail_params)
             
-            # Link media files if provided
+            # Amount excluding VAT in invoice currency, then including VAT
+            vat_percent = details_df['product_purchase_order_id'].map(vat_map).fillna(0)
+            amount_exclude_vat = base_amounts.round(2)
+            amount_include_vat = (amount_exclude_vat * (1 + vat_percent / 100)).round(2)
+            
+            detail_rows = pd.DataFrame({
+                'purchase_invoice_id': invoice_id,
+                'purchase_order_id': details_df['purchase_order_id'],
+                'product_purchase_order_id': details_df['product_purchase_order_id'],
+                'arrival_detail_id': details_df['arrival_detail_id'],
+                'purchased_invoice_quantity': quantities,
+                'invoiced_quantity': quantities,
+                'amount': amount_include_vat,
+                'amount_exclude_vat': amount_exclude_vat,
+                'vat_gst': vat_percent,
+                'exchange_rate': po_to_invoice_rate
+            }).to_dict('records')
+            
+            # Single executemany instead of one INSERT per line
+            if detail_rows:
+                conn.execute(INVOICE_DETAIL_INSERT, detail_rows)
+            
+            # Link media files if provided (one executemany for all attachments)
             if media_ids:
-                for media_id in media_ids:
-                    media_link_query = text("""
-                    INSERT INTO purchase_invoice_medias (
-                        purchase_invoice_id,
-                        media_id,
-                        created_by,
-                        created_date,
-                        delete_flag,
-                        version
-                    ) VALUES (
-                        :purchase_invoice_id,
-                        :media_id,
-                        :created_by,
-                        NOW(),
-                        0,
-                        0
-                    )
-                    """)
-                    
-                    conn.execute(media_link_query, {
-                        'purchase_invoice_id': invoice_id,
-                        'media_id': media_id,
-                        'created_by': keycloak_id
-                    })
-                    
-                    logger.info(f"Linked media {media_id} to invoice {invoice_id}")
+                conn.execute(INVOICE_MEDIA_LINK_INSERT, [
+                    {'purchase_invoice_id': invoice_id, 'media_id': media_id, 'created_by': keycloak_id}
+                    for media_id in media_ids
+                ])
+                logger.info(f"Linked media {media_ids} to invoice {invoice_id}")
             
-            logger.info(f"Invoice {invoice_data['invoice_number']} created successfully with ID {invoice_id}")
-            return True, f"Invoice {invoice_data['invoice_number']} created successfully", invoice_id
+            invoice_data['invoice_number'] = invoice_number
+            logger.info(f"Invoice {invoice_number} created successfully with ID {invoice_id}")
+            return True, f"Invoice {invoice_number} created successfully", invoice_id
             
     except Exception as e:
         logger.error(f"Error creating invoice: {e}")
         return False, f"Error creating invoice: {str(e)}", None
 
-def generate_invoice_number(vendor_id: int, buyer_id: int, is_advance_payment: bool = False) -> str:
-    """Generate unique invoice number"""
+def format_invoice_number(vendor_id: int, buyer_id: int, seq: int, is_advance_payment: bool = False) -> str:
+    """Format invoice number as V-INV{date}-{vendor}{buyer}{seq}-{P|A}"""
+    date_str = datetime.now().strftime("%Y%m%d")
+    vendor_id = int(vendor_id) if vendor_id is not None else 0
+    buyer_id = int(buyer_id) if buyer_id is not None else 0
+    suffix = 'A' if is_advance_payment else 'P'
+    
+    return f"V-INV{date_str}-{vendor_id}{buyer_id}{seq}-{suffix}"
+
+# Atomic global counter (table and seed row in sql/invoice_number_sequence.sql), seeded from
+# MAX(purchase_invoices.id) so it continues the previous MAX(id)+1 numbering. Being global,
+# two numbers of the same day can only share their digits if more invoices are created that
+# day than the counter's value. LAST_INSERT_ID(expr) makes the server report the new value
+# as the statement's insert id (cursor.lastrowid)
+INVOICE_SEQUENCE_NAME = 'purchase_invoice'
+
+INVOICE_SEQUENCE_MISSING = (
+    "Invoice number sequence is not set up, apply sql/invoice_number_sequence.sql"
+)
+
+INVOICE_SEQUENCE_ALLOCATE = text("""
+UPDATE invoice_number_sequence
+SET seq = LAST_INSERT_ID(seq + 1)
+WHERE name = :name
+""")
+
+def allocate_invoice_sequence(conn) -> int:
+    """Reserve the next invoice sequence on an open connection"""
     try:
-        engine = get_db_engine()
-        
-        today = datetime.now()
-        date_str = today.strftime("%Y%m%d")
-        
-        vendor_id = int(vendor_id) if vendor_id is not None else 0
-        buyer_id = int(buyer_id) if buyer_id is not None else 0
-        
-        query = text("""
-        SELECT MAX(id) as max_id
-        FROM purchase_invoices
-        """)
-        
-        with engine.connect() as conn:
-            result = conn.execute(query).fetchone()
-            last_id = result[0] if result and result[0] else 0
-        
-        seq = last_id + 1
-        suffix = 'A' if is_advance_payment else 'P'
-        
-        invoice_number = f"V-INV{date_str}-{vendor_id}{buyer_id}{seq}-{suffix}"
-        
-        return invoice_number
-        
-    except Exception as e:
-        logger.error(f"Error generating invoice number: {e}")
-        vendor_id = int(vendor_id) if vendor_id is not None else 0
-        buyer_id = int(buyer_id) if buyer_id is not None else 0
-        suffix = 'A' if is_advance_payment else 'P'
-        timestamp = datetime.now().strftime('%H%M%S')
-        return f"V-INV{datetime.now().strftime('%Y%m%d')}-{vendor_id}{buyer_id}{timestamp}-{suffix}"
+        result = conn.execute(INVOICE_SEQUENCE_ALLOCATE, {'name': INVOICE_SEQUENCE_NAME})
+    except ProgrammingError as e:
+        raise ValueError(INVOICE_SEQUENCE_MISSING) from e
+    
+    if result.rowcount != 1:
+        raise ValueError(INVOICE_SEQUENCE_MISSING)
+    
+    return int(result.lastrowid)
+
+def reserve_invoice_number(vendor_id: int, buyer_id: int, is_advance_payment: bool = False) -> str:
+    """
+    Allocate the final invoice number ahead of create_purchase_invoice
+    
+    For steps that need the number before the insert (attachment file names). The number
+    is committed at once, so it is skipped if the invoice is then not created.
+    """
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        seq = allocate_invoice_sequence(conn)
+    return format_invoice_number(vendor_id, buyer_id, seq, is_advance_payment)
+
+# Active payment terms for the invoice form
+PAYMENT_TERMS_QUERY = text("""
+SELECT 
+    id,
+    name,
+    COALESCE(description, name) AS description
+FROM payment_terms
+WHERE delete_flag = 0
+ORDER BY name ASC
+""")
 
 @st.cache_data(ttl=3600)  # Cache for 1 hour
 def get_payment_terms() -> pd.DataFrame:
@@ -611,22 +799,17 @@ def get_payment_terms() -> pd.DataFrame:
     try:
         engine = get_db_engine()
         
-        query = text("""
-        SELECT 
-            id,
-            name,
-            COALESCE(description, name) AS description
-        FROM payment_terms
-        WHERE delete_flag = 0
-        ORDER BY name ASC
-        """)
-        
+        # A handful of rows: plain tuples and one DataFrame build beat read_sql here
         with engine.connect() as conn:
-            df = pd.read_sql(query, conn)
+            rows = conn.execute(PAYMENT_TERMS_QUERY).fetchall()
         
-        if not df.empty:
-            df['days'] = df['name'].apply(calculate_days_from_term_name)
-            df = df.sort_values(['days', 'name'])
+        terms = sorted(
+            ({'id': term_id, 'name': name, 'description': description,
+              'days': calculate_days_from_term_name(name)}
+             for term_id, name, description in rows),
+            key=lambda term: (term['days'], term['name'] or '')
+        )
+        df = pd.DataFrame(terms, columns=['id', 'name', 'description', 'days'])
         
         if df.empty:
             df = pd.DataFrame([
@@ -689,7 +872,71 @@ def calculate_days_from_term_name(term_name: str) -> int:
     
     return 30
 
-@st.cache_data(ttl=60)
+def calculate_days_from_term_names(term_names: pd.Series) -> pd.Series:
+    """
+    Column version of calculate_days_from_term_name
+    
+    Same rules and precedence, evaluated with one regex pass per rule over the whole column.
+    """
+    terms = term_names.astype(str).str.strip()
+    terms_upper = terms.str.upper()
+    
+    def first_number(values, pattern):
+        return pd.to_numeric(values.str.extract(pattern, expand=False))
+    
+    # Later rules only apply where earlier ones found nothing
+    days = first_number(terms_upper, r'NET\s+(\d+)')
+    days = days.fillna(first_number(terms_upper, r'AMS\s+(\d+)') + 15)  # Approximate
+    days = days.fillna(first_number(terms_upper, r'(\d+)\s*DAYS?'))
+    days = days.fillna(first_number(terms, r'(\d+)'))
+    days = days.fillna(30)
+    
+    # Immediate payment
+    days = days.mask(terms_upper.str.contains('COD|CIA|TT IN ADVANCE|ADVANCE|PREPAID'), 0)
+    
+    return days.mask(term_names.isna(), 30).astype(int)
+
+# PO line totals; legacy quantities come from get_legacy_invoice_source
+PO_LINE_SUMMARY_QUERY = """
+WITH new_invoices AS (
+    SELECT 
+        pid.product_purchase_order_id,
+        SUM(pid.purchased_invoice_quantity) as new_invoice_qty
+    FROM purchase_invoice_details pid
+    JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
+    WHERE pid.arrival_detail_id IS NOT NULL
+        AND pid.delete_flag = 0
+        AND pi.delete_flag = 0
+        AND pid.product_purchase_order_id IN :po_line_ids
+    GROUP BY pid.product_purchase_order_id
+)
+SELECT 
+    ppo.id as product_purchase_order_id,
+    po.po_number,
+    p.pt_code,
+    p.name as product_name,
+    ppo.purchase_quantity as po_buying_qty,
+    COALESCE(li.legacy_invoice_qty, 0) as legacy_invoice_qty,
+    COALESCE(ni.new_invoice_qty, 0) as new_invoice_qty,
+    ppo.purchase_quantity - (COALESCE(li.legacy_invoice_qty, 0) + COALESCE(ni.new_invoice_qty, 0)) as po_remaining_qty
+FROM product_purchase_orders ppo
+JOIN purchase_orders po ON ppo.purchase_order_id = po.id
+JOIN products p ON ppo.product_id = p.id
+LEFT JOIN {legacy_source} li ON li.product_purchase_order_id = ppo.id
+LEFT JOIN new_invoices ni ON ni.product_purchase_order_id = ppo.id
+WHERE ppo.id IN :po_line_ids
+    AND ppo.delete_flag = 0
+    AND po.delete_flag = 0
+"""
+
+PO_LINE_SUMMARY_STATEMENTS = {
+    source: text(PO_LINE_SUMMARY_QUERY.format(legacy_source=source)).bindparams(
+        bindparam('po_line_ids', expanding=True)
+    )
+    for source in (LEGACY_INVOICE_SUMMARY_TABLE, LEGACY_INVOICE_SUMMARY_INLINE)
+}
+
+@st.cache_data(ttl=60, show_spinner=False)  # Also called from a background thread
 def get_po_line_summary(po_line_ids: List[int]) -> pd.DataFrame:
     """
     Get PO line level summary including legacy invoice information
@@ -700,53 +947,11 @@ def get_po_line_summary(po_line_ids: List[int]) -> pd.DataFrame:
         
         engine = get_db_engine()
         
-        query = text("""
-        WITH legacy_invoices AS (
-            SELECT 
-                pid.product_purchase_order_id,
-                SUM(pid.purchased_invoice_quantity) as legacy_invoice_qty,
-                COUNT(DISTINCT pid.purchase_invoice_id) as legacy_invoice_count
-            FROM purchase_invoice_details pid
-            JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
-            WHERE pid.arrival_detail_id IS NULL
-                AND pid.delete_flag = 0
-                AND pi.delete_flag = 0
-                AND pid.product_purchase_order_id IN :po_line_ids
-            GROUP BY pid.product_purchase_order_id
-        ),
-        new_invoices AS (
-            SELECT 
-                pid.product_purchase_order_id,
-                SUM(pid.purchased_invoice_quantity) as new_invoice_qty
-            FROM purchase_invoice_details pid
-            JOIN purchase_invoices pi ON pid.purchase_invoice_id = pi.id
-            WHERE pid.arrival_detail_id IS NOT NULL
-                AND pid.delete_flag = 0
-                AND pi.delete_flag = 0
-                AND pid.product_purchase_order_id IN :po_line_ids
-            GROUP BY pid.product_purchase_order_id
-        )
-        SELECT 
-            ppo.id as product_purchase_order_id,
-            po.po_number,
-            p.pt_code,
-            p.name as product_name,
-            ppo.purchase_quantity as po_buying_qty,
-            COALESCE(li.legacy_invoice_qty, 0) as legacy_invoice_qty,
-            COALESCE(ni.new_invoice_qty, 0) as new_invoice_qty,
-            ppo.purchase_quantity - (COALESCE(li.legacy_invoice_qty, 0) + COALESCE(ni.new_invoice_qty, 0)) as po_remaining_qty
-        FROM product_purchase_orders ppo
-        JOIN purchase_orders po ON ppo.purchase_order_id = po.id
-        JOIN products p ON ppo.product_id = p.id
-        LEFT JOIN legacy_invoices li ON li.product_purchase_order_id = ppo.id
-        LEFT JOIN new_invoices ni ON ni.product_purchase_order_id = ppo.id
-        WHERE ppo.id IN :po_line_ids
-            AND ppo.delete_flag = 0
-            AND po.delete_flag = 0
-        """)
-        
         with engine.connect() as conn:
-            df = pd.read_sql(query, conn, params={'po_line_ids': tuple(po_line_ids)})
+            df = pd.read_sql(
+                PO_LINE_SUMMARY_STATEMENTS[get_legacy_invoice_source()], conn,
+                params={'po_line_ids': tuple(po_line_ids)}
+            )
         
         return df
         
@@ -758,6 +963,36 @@ def get_po_line_summary(po_line_ids: List[int]) -> pd.DataFrame:
 # INVOICE MANAGEMENT FUNCTIONS (CRUD)
 # ============================================================================
 
+# Latest invoices from purchase_invoice_full_view (one row per invoice after dedupe)
+RECENT_INVOICES_QUERY = text("""
+SELECT DISTINCT
+    pi_id as id,
+    inv_number as invoice_number,
+    commercial_inv_number as commercial_invoice_no,
+    inv_date as invoiced_date,
+    due_date,
+    total_invoiced_amount,
+    vendor,
+    vendor_code,
+    legal_entity as buyer,
+    legal_entity_code as buyer_code,
+    invoiced_currency as currency,
+    payment_term,
+    created_by,
+    inv_type as invoice_type,
+    is_advance_payment as advance_payment,
+    payment_status,
+    total_outstanding_amount,
+    aging_status,
+    risk_level,
+    days_overdue,
+    payment_count,
+    last_payment_date
+FROM purchase_invoice_full_view
+ORDER BY inv_date DESC, inv_number DESC
+LIMIT :limit
+""")
+
 @st.cache_data(ttl=60)
 def get_recent_invoices(limit: int = 100) -> pd.DataFrame:
     """
@@ -766,42 +1001,27 @@ def get_recent_invoices(limit: int = 100) -> pd.DataFrame:
     try:
         engine = get_db_engine()
         
-        query = text("""
-        SELECT DISTINCT
-            pi_id as id,
-            inv_number as invoice_number,
-            commercial_inv_number as commercial_invoice_no,
-            inv_date as invoiced_date,
-            due_date,
-            total_invoiced_amount,
-            vendor,
-            vendor_code,
-            legal_entity as buyer,
-            legal_entity_code as buyer_code,
-            invoiced_currency as currency,
-            payment_term,
-            created_by,
-            inv_type as invoice_type,
-            is_advance_payment as advance_payment,
-            payment_status,
-            total_outstanding_amount,
-            aging_status,
-            risk_level,
-            days_overdue,
-            payment_count,
-            last_payment_date
-        FROM purchase_invoice_full_view
-        ORDER BY inv_date DESC, inv_number DESC
-        LIMIT :limit
-        """)
-        
         with engine.connect() as conn:
-            df = pd.read_sql(query, conn, params={'limit': limit})
+            df = pd.read_sql(RECENT_INVOICES_QUERY, conn, params={'limit': limit})
             
             # Remove duplicates and add line count
             if not df.empty:
                 df = df.drop_duplicates(subset=['id'])
         
+        # Parse dates once here so cached callers don't re-parse on every rerun
+        for col in ['invoiced_date', 'due_date', 'last_payment_date']:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+        
+        # Flag advance payment invoices once for type filters and metrics
+        if 'invoice_number' in df.columns:
+            df['is_advance'] = df['invoice_number'].str.endswith('-A', na=False)
+        
+        # Repeated strings as categories so groupby/nunique work on integer codes
+        for col in INVOICE_CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        
         return df
         
     except Exception as e:
@@ -2,12 +2,50 @@
 
 from datetime import datetime, timedelta
 import pandas as pd
+import numpy as np
+import streamlit as st
 from typing import Dict, List, Optional, Tuple
 import logging
 from .invoice_data import get_payment_terms, get_po_line_summary
 
 logger = logging.getLogger(__name__)
 
+def split_unit_cost(buying_unit_cost: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Split "123.45 USD" cost strings into numeric unit costs and currency codes
+    
+    Values without a currency part get NaN/None, matching the per-row parsing they replace.
+    """
+    tokens = buying_unit_cost.astype(str).str.split()
+    currencies = tokens.str[1]
+    unit_costs = pd.to_numeric(tokens.str[0], errors='coerce').where(currencies.notna())
+    return unit_costs, currencies
+
+@st.cache_data(ttl=3600, show_spinner=False)  # Same lifetime as get_payment_terms
+def load_payment_terms_dict() -> Dict:
+    """Get payment terms as dictionary keyed by ID (memoized across reruns)"""
+    try:
+        df = get_payment_terms()
+        # Convert to dictionary with ID as key
+        descriptions = df['description'] if 'description' in df.columns else [''] * len(df)
+        return {
+            term_id: {
+                'name': name,
+                'days': days,
+                'description': description
+            }
+            for term_id, name, days, description in zip(df['id'], df['name'], df['days'], descriptions)
+        }
+    except Exception as e:
+        logger.error(f"Error getting payment terms dict: {e}")
+        # Return default if error
+        return {
+            1: {'name': 'Net 30', 'days': 30, 'description': 'Payment due in 30 days'},
+            2: {'name': 'Net 60', 'days': 60, 'description': 'Payment due in 60 days'},
+            3: {'name': 'Net 90', 'days': 90, 'description': 'Payment due in 90 days'},
+            4: {'name': 'COD', 'days': 0, 'description': 'Cash on delivery'}
+        }
+
 class InvoiceService:
     """Service class for invoice business logic with enhanced PO level validation"""
     
@@ -27,22 +65,15 @@ class InvoiceService:
         }
         
         # Calculate total value
-        total_value = 0
-        currency = None
-        
-        for _, row in df.iterrows():
-            cost_parts = str(row['buying_unit_cost']).split()
-            if len(cost_parts) >= 2:
-                unit_cost = float(cost_parts[0])
-                if not currency:
-                    currency = cost_parts[1]
-                
-                # Use true_remaining_qty if available
-                qty = row.get('true_remaining_qty', row['uninvoiced_quantity'])
-                total_value += unit_cost * qty
+        unit_costs, currencies = split_unit_cost(df['buying_unit_cost'])
+        has_cost = currencies.notna()
+        
+        # Use true_remaining_qty if available
+        qty = df['true_remaining_qty'] if 'true_remaining_qty' in df.columns else df['uninvoiced_quantity']
+        total_value = (unit_costs[has_cost] * qty[has_cost]).sum()
         
-        totals['total_value'] = round(total_value, 2)
-        totals['currency'] = currency or 'USD'
+        totals['total_value'] = round(float(total_value), 2)
+        totals['currency'] = currencies[has_cost].iloc[0] if has_cost.any() else 'USD'
         
         return totals
 
@@ -57,30 +88,21 @@ class InvoiceService:
         }
         
         # Calculate subtotal and VAT
-        subtotal = 0
-        total_vat = 0
-        currency = None
-        
-        for _, row in df.iterrows():
-            cost_parts = str(row['buying_unit_cost']).split()
-            if len(cost_parts) >= 2:
-                unit_cost = float(cost_parts[0])
-                if not currency:
-                    currency = cost_parts[1]
-                
-                qty = row.get('true_remaining_qty', row['uninvoiced_quantity'])
-                line_amount = unit_cost * qty
-                subtotal += line_amount
-                
-                # Calculate VAT
-                vat_percent = row.get('vat_percent', 0)
-                vat_amount = line_amount * vat_percent / 100
-                total_vat += vat_amount
+        unit_costs, currencies = split_unit_cost(df['buying_unit_cost'])
+        has_cost = currencies.notna()
+        
+        qty = df['true_remaining_qty'] if 'true_remaining_qty' in df.columns else df['uninvoiced_quantity']
+        line_amounts = unit_costs[has_cost] * qty[has_cost]
+        subtotal = float(line_amounts.sum())
+        
+        # Calculate VAT
+        vat_percent = df['vat_percent'][has_cost] if 'vat_percent' in df.columns else 0
+        total_vat = float((line_amounts * vat_percent / 100).sum())
         
         totals['subtotal'] = round(subtotal, 2)
         totals['total_vat'] = round(total_vat, 2)
         totals['total_with_vat'] = round(subtotal + total_vat, 2)
-        totals['currency'] = currency or 'USD'
+        totals['currency'] = currencies[has_cost].iloc[0] if has_cost.any() else 'USD'
         
         return totals
 
@@ -88,7 +110,7 @@ class InvoiceService:
     def prepare_invoice_summary(df: pd.DataFrame) -> pd.DataFrame:
         """Prepare summary for invoice preview with ID column (used at lines 844, 847)"""
         # Group by PO, product, and VAT rate
-        summary = df.groupby(['po_number', 'pt_code', 'product_name', 'buying_unit_cost', 'vat_percent']).agg({
+        summary = df.groupby(['po_number', 'pt_code', 'product_name', 'buying_unit_cost', 'vat_percent'], observed=True).agg({
             'uninvoiced_quantity': 'sum',
             'true_remaining_qty': 'sum' if 'true_remaining_qty' in df.columns else lambda x: None,
             'arrival_note_number': lambda x: ', '.join(x.unique())
@@ -104,31 +126,25 @@ class InvoiceService:
             qty_col = 'uninvoiced_quantity'
         
         # Calculate amounts
-        summary['line_amount'] = summary.apply(
-            lambda row: float(str(row['buying_unit_cost']).split()[0]) * row[qty_col], 
-            axis=1
-        )
+        unit_costs = summary['buying_unit_cost'].astype(str).str.split().str[0].astype(float)
+        summary['line_amount'] = unit_costs * summary[qty_col]
         
         summary['vat_amount'] = summary['line_amount'] * summary['vat_percent'] / 100
         summary['total_amount'] = summary['line_amount'] + summary['vat_amount']
         
         # Format for display
-        summary['vat_display'] = summary['vat_percent'].apply(lambda x: f"{x:.0f}%")
+        summary['vat_display'] = summary['vat_percent'].map('{:.0f}%'.format)
         
         # Add warning if quantity was adjusted
         if 'true_remaining_qty' in summary.columns:
-            summary['adjusted'] = summary.apply(
-                lambda row: '⚠️' if row.get('true_remaining_qty', 0) < row['uninvoiced_quantity'] else '',
-                axis=1
-            )
+            summary['adjusted'] = np.where(summary['true_remaining_qty'] < summary['uninvoiced_quantity'], '⚠️', '')
         
         # Format monetary values
-        summary['line_amount'] = summary['line_amount'].apply(lambda x: f"{x:,.2f}")
-        summary['vat_amount'] = summary['vat_amount'].apply(lambda x: f"{x:,.2f}")
-        summary['total_amount'] = summary['total_amount'].apply(lambda x: f"{x:,.2f}")
+        for col in ['line_amount', 'vat_amount', 'total_amount']:
+            summary[col] = summary[col].map('{:,.2f}'.format)
         
         # Format quantity with 2 decimal places
-        summary[qty_col] = summary[qty_col].apply(lambda x: f"{x:,.2f}")
+        summary[qty_col] = summary[qty_col].map('{:,.2f}'.format)
         
         # Rename columns
         columns_rename = {
@@ -161,10 +177,13 @@ class InvoiceService:
         return summary[display_cols]
     
     @staticmethod
-    def validate_invoice_with_po_level(df: pd.DataFrame) -> Tuple[Dict, Dict]:
+    def validate_invoice_with_po_level(df: pd.DataFrame, po_summary: Optional[pd.DataFrame] = None) -> Tuple[Dict, Dict]:
         """
         Enhanced validation with PO level checks (used at line 572)
         
+        po_summary can be passed in when it was already loaded (e.g. prefetched);
+        otherwise it is fetched with get_po_line_summary.
+        
         Returns:
             (validation_results, messages)
         """
@@ -211,7 +230,8 @@ class InvoiceService:
         if 'product_purchase_order_id' in df.columns:
             po_line_ids = df['product_purchase_order_id'].unique().tolist()
             try:
-                po_summary = get_po_line_summary(po_line_ids)
+                if po_summary is None:
+                    po_summary = get_po_line_summary(tuple(sorted(po_line_ids)))
                 
                 if not po_summary.empty:
                     for po_id in po_line_ids:
@@ -295,23 +315,4 @@ class InvoiceService:
     @staticmethod
     def get_payment_terms_dict() -> Dict:
         """Get available payment terms as dictionary (used at line 950)"""
-        try:
-            df = get_payment_terms()
-            # Convert to dictionary with ID as key
-            return {
-                row['id']: {
-                    'name': row['name'],
-                    'days': row['days'],
-                    'description': row.get('description', '')
-                }
-                for _, row in df.iterrows()
-            }
-        except Exception as e:
-            logger.error(f"Error getting payment terms dict: {e}")
-            # Return default if error
-            return {
-                1: {'name': 'Net 30', 'days': 30, 'description': 'Payment due in 30 days'},
-                2: {'name': 'Net 60', 'days': 60, 'description': 'Payment due in 60 days'},
-                3: {'name': 'Net 90', 'days': 90, 'description': 'Payment due in 90 days'},
-                4: {'name': 'COD', 'days': 0, 'description': 'Cash on delivery'}
-            }
\ No newline at end of file
+        return load_payment_terms_dict()
\ No newline at end of file
@@ -3,6 +3,7 @@ Enhanced Payment Terms Calculator
 Handles all payment term types from database with proper categorization
 """
 import re
+from functools import lru_cache
 import pandas as pd
 from datetime import datetime, date, timedelta
 from typing import Tuple, Optional
@@ -165,6 +166,7 @@ class PaymentTermParser:
         return None
     
     @staticmethod
+    @lru_cache(maxsize=1024)  # Pure in its arguments; reruns repeat the same term/date pair
     def calculate_due_date(
         term_name: str,
         invoice_date: date,